@@ -2,27 +2,43 @@ import os
 import re
 import json
 import copy
-from SPARQLWrapper import SPARQLWrapper, JSON
-from simplejson import dumps
+import itertools
+import heapq
+import zlib
+import time
+import random
+import threading
+from json import dumps
 from typing import Callable
-import pprint
 import logging
 #import sys
 #from loguru import logger # ...alternate logger
 
+# NOTE: SPARQLWrapper, concurrent.futures, pprint, argparse, pickle and tempfile are imported on first use, to keep the
+#       module import fast. Logging is only configured when a transform runs in debug mode.
+
 # Setup Logging...
-logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.WARNING)
+LOG_FORMAT = '%(levelname)s:%(message)s'
 logger = logging.getLogger('sparql_transformer')
+loggerDebug = logging.getLogger('sparql_transformer.debug') # ...used by the transformers in debug mode
+loggerDebug.setLevel(logging.DEBUG)
 #logger.remove()
 #logger.add(sys.stderr, level="WARNING")
 
 INDENT = '  '
+BUNDLE_VERSION = 1
+_VALUES_TOKEN = '%%VALUES%%'
+# GROUP_CONCAT separators: control characters that do not occur in values...
+_CONCAT_SEPARATOR = '\x1f'
+_CONCAT_FIELD = '\x1e'
+_CONCAT_SEPARATOR_SPARQL = '\\u001F'
+_CONCAT_FIELD_SPARQL = '\\u001E'
 
 class XSD:
     _XSD = 'http://www.w3.org/2001/XMLSchema#'
 
-    def _xsd(resource):
-        return XSD._XSD + resource
+    def _xsd(resource, _XSD=_XSD):
+        return _XSD + resource
 
     XSD_INT_TYPES = [
         _xsd('integer'), _xsd('nonPositiveInteger'), _xsd('negativeInteger'),
@@ -33,6 +49,33 @@ class XSD:
     XSD_BOOLEAN_TYPES = [ _xsd('boolean') ]
     XSD_FLOAT_TYPES = [ _xsd('decimal'), _xsd('float'), _xsd('double') ]
     XSD_DATE_TYPES = [ _xsd('date'), _xsd('dateTime') ]
+    XSD_STRING_TYPES = [ _xsd('string'), 'http://www.w3.org/1999/02/22-rdf-syntax-ns#langString' ]
+
+
+class TransformRun:
+    """ The state of a single transform: the raw SPARQL results, the transformed results and
+        whether the deadline truncated them.
+    """
+
+    def __init__(self, fDeadline: float | None = None):
+        self.fDeadline = fDeadline
+        self.bTruncated = False
+        self.dictSPARQLResults = None
+        self.objResults = None
+        self.iResults = None # ...the results written by stream()
+        self.iSkippedRows = 0 # ...the duplicate bindings dropped before fitting
+        self.bCached = False # ...the results come from the cache
+        self.bRevalidated = False # ...the cached results were revalidated by the endpoint
+        self.dictValidators = {} # ...the ETag / Last-Modified of the answers, by query
+        self.setNotModified = set() # ...the queries answered 304 Not Modified
+        self.dictAnchorIndex = None # ...the bindings and results by anchor, the base of update()
+
+    def isExpired(self) -> bool:
+        return self.fDeadline is not None and time.monotonic() >= self.fDeadline
+
+    def remaining(self) -> float | None:
+        """The time left before the deadline, if any"""
+        return max(0.0, self.fDeadline - time.monotonic()) if self.fDeadline is not None else None
 
 
 class SPARQLTransformer:
@@ -61,10 +104,24 @@ class SPARQLTransformer:
     }
 
     _LANG_REGEX = re.compile(r"^lang(?::(.+))?")
+    _LANG_PRIORITY_REGEX = re.compile(r"([A-Za-z*][\w-]*)\s*(?:;\s*q\s*=\s*([\d.]+))?")
     _AGGREGATES = ['sample', 'count', 'sum', 'min', 'max', 'avg']
 
     _RDF_VALUE_TYPES = ['uri', 'literal']
 
+    # VALUES term classifiers...
+    _VALUES_CIRIE_REGEX = re.compile(r"^(\w[\w!$&'()*+,\-.;=?@~]*):[\w!$&'()*+,\-.;=?@~]+$", re.UNICODE)
+    _VALUES_LANG_REGEX = re.compile(r"^(.+)@([a-z]{2,3}(?:_[A-Z]{2})?)$", re.DOTALL)
+    _VALUES_DTYPE_REGEX = re.compile(r"^(.+)\^\^(.+)$", re.DOTALL)
+    _LITERAL_ESCAPES = str.maketrans({ '\\': '\\\\', '"': '\\"', '\n': '\\n', '\r': '\\r' })
+
+    # Options used by the fitting, as sent to the worker processes...
+    _FIT_OPTIONS = ['langTag', 'voc', 'shareNodes', 'bestlang']
+    # Options set by the query compilation, as saved in a plan...
+    _PLAN_OPTIONS = ['context', 'langTag', 'is_json_ld', 'voc', 'limit', 'offset', 'bestlang']
+    # Options changing the results of the same queries, as part of the cache key...
+    _RESULT_OPTIONS = _PLAN_OPTIONS + ['shareNodes', 'flatten']
+
     _KNOWN_ACCESS_TYPES = {
         'int': [int],
         'float': [float],
@@ -78,37 +135,292 @@ class SPARQLTransformer:
     }
 
     def __init__(self, objQuery: str | dict, dictOptions: dict | None = None ):
+        # NOTE: The compiled query (dictProperties, listSPARQLQueries, dictOptions) is set once and then only read,
+        #       while the state of each transform lives in its own TransformRun, so a transformer can be shared
+        #       across threads...
         self.objQuery = copy.deepcopy(objQuery)
         self.dictJSONQuery = None
+        self.bCompiled = False
+        self.lockCompile = threading.Lock()
+        self.listFitVars = None
+        self.dictNodeVars = {}
+        self.tupleCacheKey = None
+        self.listTableColumns = None
+        self.dictLangPriorities = {}
         self.dictOptions = SPARQLTransformer._DEFAULT_OPTIONS.copy()
         if dictOptions is not None:
             self.dictOptions.update(dictOptions)
+        # The debug mode logs through its own logger, rather than changing the level of the shared one...
         self.logLevel = None
         if 'debug' in self.dictOptions and self.dictOptions['debug']:
             self.logLevel = logging.DEBUG
-            logger.setLevel(self.logLevel) # 10
+            logging.basicConfig(format=LOG_FORMAT) # ...no-op when the application configured logging
+            self.logger = loggerDebug
             #self.logLevel = logger.level("DEBUG").no # 10
             #logger.remove()
             #logger.add(sys.stderr, level=self.logLevel)
         else:
             self.logLevel = logging.WARNING
-            logger.setLevel(self.logLevel) # 30 (Normal), logging.NOTSET == 0
-            #self.logLevel = logger.level("WARNING").no # 30
-            #logger.remove()
-            #logger.add(sys.stderr, level=self.logLevel)
-
+            self.logger = logger
+
+
+    @classmethod
+    def fromPlan(cls, dictPlan: dict, dictOptions: dict | None = None):
+        """Create a transformer from a precompiled plan (see plan() and loadBundle()), skipping the query compilation"""
+        objTransformer = cls(None, dictOptions)
+        objTransformer.dictOptions.update(dictPlan['options'])
+        objTransformer.dictProperties = dictPlan['properties']
+        objTransformer.listSPARQLQueries = dictPlan['queries']
+        objTransformer.strSPARQLQuery = objTransformer.listSPARQLQueries[0]
+        objTransformer.bCompiled = True
+        return objTransformer
+
+    @classmethod
+    def forFitting(cls, dictProperties: dict, dictOptions: dict | None = None):
+        """Create a transformer that only fits bindings to a compiled prototype (e.g. in a worker process), with no SPARQL queries"""
+        objTransformer = cls(None, dictOptions)
+        objTransformer.dictProperties = dictProperties
+        objTransformer.listSPARQLQueries = []
+        objTransformer.strSPARQLQuery = None
+        objTransformer.bCompiled = True
+        return objTransformer
+
+    def plan(self) -> dict:
+        """Get the compiled query: the SPARQL queries, the compiled prototype and the compiled options"""
+        self.__compile()
+        return {
+            'queries': self.listSPARQLQueries,
+            'properties': self.dictProperties,
+            'options': { strKey: self.dictOptions[strKey] for strKey in SPARQLTransformer._PLAN_OPTIONS if strKey in self.dictOptions }
+        }
 
     def transform(self):
-        self.__preProcess()
+        return self.run().objResults # list or dict
+
+    def run(self):
+        """Run a transform, returning its TransformRun: the results and the state of the run"""
+        objCache = self.dictOptions.get('cache', None)
+        dictEntry = None
+        if objCache is not None:
+            self.__compile()
+            dictEntry, bFresh = objCache.lookup( self.__cacheKey() )
+            if dictEntry is not None and bFresh:
+                return self.__cachedRun(dictEntry)
+
+        # An expired entry is revalidated with conditional requests, when the module queries the endpoint...
+        dictConditional = None
+        if dictEntry is not None and 'sparqlFunction' not in self.dictOptions:
+            dictConditional = dictEntry.get('validators', None)
+        objRun = self.__query(dictConditional)
+        if objRun.setNotModified:
+            if len(objRun.setNotModified) == len(self.listSPARQLQueries) and not objRun.bTruncated:
+                objCache.touch( self.__cacheKey() )
+                objRun = self.__cachedRun(dictEntry)
+                objRun.bRevalidated = True
+                return objRun
+            # Only partly unchanged: query again in full, within the same time budget...
+            objRun = self.__query(fDeadline=objRun.fDeadline)
+
+        # Process raw objRun.dictSPARQLResults into objRun.objResults...
+        self.__postProcess(objRun)
+        if objCache is not None and not objRun.bTruncated:
+            objCache.put( self.__cacheKey(), {
+                'bindings': objRun.dictSPARQLResults,
+                'results': copy.deepcopy(objRun.objResults),
+                'validators': objRun.dictValidators
+            } )
+        return objRun
+
+    def __cachedRun(self, dictEntry: dict):
+        objRun = TransformRun()
+        objRun.dictSPARQLResults = dictEntry['bindings']
+        objRun.objResults = copy.deepcopy(dictEntry['results']) # ...the cached results stay unchanged
+        objRun.bCached = True
+        return objRun
+
+    def __cacheKey(self) -> tuple:
+        """The key of the results in the cache: the source, the queries and what shapes their results"""
+        if self.tupleCacheKey is None:
+            objSource = self.dictOptions.get('sparqlFunction', None) or self.dictOptions['endpoint']
+            self.tupleCacheKey = (
+                tuple(objSource) if isinstance(objSource, list) else objSource,
+                tuple(self.listSPARQLQueries),
+                dumps(self.dictProperties, sort_keys=True),
+                dumps({ strKey: self.dictOptions[strKey] for strKey in SPARQLTransformer._RESULT_OPTIONS if strKey in self.dictOptions }, sort_keys=True)
+            )
+        return self.tupleCacheKey
 
-        funcSPAQRLQuery = self.dictOptions['sparqlFunction'] if 'sparqlFunction' in self.dictOptions else self.__defaultSPARQLQuery()
-        self.dictSPARQLResults = funcSPAQRLQuery(self.strSPARQLQuery)
+    def stream(self, funcWriter: Callable):
+        """ Run a transform without holding the results, passing each result to funcWriter instead of returning them.
+            The fitted results are spilled to temporary runs of 'spillRows' results sorted by anchor, then merged,
+            so the results come out in anchor order. Return the TransformRun, counting the results in iResults.
+        """
+        objRun = self.__query()
+        self.__spillProcess(objRun, funcWriter)
+        return objRun
+
+    def table(self, strFormat: str = 'dict'):
+        """ Run a transform into columns, straight from the bindings: one row per binding (without the duplicates
+            dropped by transform()) and a column per variable of the prototype, named by its dotted path.
+            The values are typed from their XSD datatype. Return a dict of lists ('dict'), a NumPy structured
+            array ('numpy') or a pandas DataFrame ('pandas').
+        """
+        if strFormat not in ('dict', 'numpy', 'pandas'):
+            raise ValueError('Unknown table format [%s]' % strFormat)
+        objRun = self.__query()
+        listBindings = self.__dedupBindings(objRun.dictSPARQLResults['results']['bindings'], objRun)
+        if self.dictOptions.get('bestlang', None):
+            listBindings = self.__bestLanguageRows(listBindings)
+        listBindings = self.__limitRows(listBindings)
+
+        dictColumns = {}
+        for strColumn, strVar, bConcat, strAccept in self.__tableColumns():
+            listTypes = SPARQLTransformer._KNOWN_ACCESS_TYPES.get(strAccept, None) if strAccept else None
+            listValues = []
+            for dictBinding in listBindings:
+                dictValue = dictBinding.get(strVar, None)
+                if dictValue is None:
+                    listValues.append(None)
+                elif bConcat:
+                    listCell = [
+                        objValue for objValue in map( SPARQLTransformer.__tableValue, SPARQLTransformer.__decodeConcat( dictValue.get('value', '') ) )
+                        if objValue is not None and ( listTypes is None or type(objValue) in listTypes )
+                    ]
+                    listValues.append(listCell or None)
+                else:
+                    objValue = SPARQLTransformer.__tableValue(dictValue)
+                    listValues.append( objValue if listTypes is None or type(objValue) in listTypes else None )
+            dictColumns[strColumn] = listValues
+
+        if strFormat == 'dict':
+            return dictColumns
+        if strFormat == 'numpy':
+            try:
+                import numpy
+            except ImportError:
+                raise ImportError('The numpy table format requires NumPy')
+            dictNumpyTypes = { int: 'i8', float: 'f8', bool: '?' }
+            listDTypes = []
+            for strColumn, listValues in dictColumns.items():
+                typeColumn, bMissing = SPARQLTransformer.__columnType(listValues)
+                strDType = dictNumpyTypes.get(typeColumn, 'O')
+                if bMissing and strDType == 'i8':
+                    strDType = 'f8' # ...missing values as NaN
+                elif bMissing and strDType == '?':
+                    strDType = 'O'
+                listDTypes.append( (strColumn, strDType) )
+            arrayTable = numpy.empty( len(listBindings), dtype=listDTypes )
+            for strColumn, strDType in listDTypes:
+                listValues = dictColumns[strColumn]
+                if strDType == 'f8':
+                    listValues = [ numpy.nan if objValue is None else objValue for objValue in listValues ]
+                arrayTable[strColumn] = listValues
+            return arrayTable
+        try:
+            import pandas
+        except ImportError:
+            raise ImportError('The pandas table format requires pandas')
+        dictPandasTypes = { int: ('int64', 'Int64'), float: ('float64', 'float64'), bool: ('bool', 'boolean') }
+        dictSeries = {}
+        for strColumn, listValues in dictColumns.items():
+            typeColumn, bMissing = SPARQLTransformer.__columnType(listValues)
+            tupleDTypes = dictPandasTypes.get(typeColumn, ('object', 'object'))
+            dictSeries[strColumn] = pandas.Series( listValues, dtype=tupleDTypes[1] if bMissing else tupleDTypes[0] )
+        return pandas.DataFrame(dictSeries)
+
+    def __tableColumns(self) -> list[tuple]:
+        """Get the columns of the prototype variables: the dotted path, the variable, $concat and $accept"""
+        if self.listTableColumns is None:
+            listColumns = []
+            listItems = [ ((), self.dictProperties) ]
+            while listItems:
+                tuplePath, dictItem = listItems.pop(0)
+                for strKey, objValue in dictItem.items():
+                    if strKey.startswith('$'):
+                        continue
+                    if isinstance(objValue, dict):
+                        listItems.append( (tuplePath + (strKey,), objValue) )
+                    elif isinstance(objValue, str) and objValue.startswith('?'):
+                        strVar = objValue[1:].split('$')[0]
+                        strAccept = objValue.split('$accept:')[1].split('$')[0] if '$accept:' in objValue else None
+                        listColumns.append( ('.'.join(tuplePath + (strKey,)), strVar, '$concat' in objValue, strAccept) )
+            self.listTableColumns = listColumns
+        return self.listTableColumns
+
+    def __limitRows(self, listBindings: list) -> list:
+        """Apply the library limit to the rows: the rows of the limited objects, by anchor"""
+        if 'limit' not in self.dictOptions:
+            return listBindings
+        iOffset = self.dictOptions.get('offset', 0)
+        iEnd = iOffset + self.dictOptions['limit']
+        strAnchorVar = self.__anchorVariable()
+        if strAnchorVar is None:
+            return listBindings[iOffset:iEnd]
+        dictOrder = {}
+        listRows = []
+        for dictBinding in listBindings:
+            iObject = dictOrder.setdefault( SPARQLTransformer.__bindingAnchorKey(dictBinding, strAnchorVar), len(dictOrder) )
+            if iOffset <= iObject < iEnd:
+                listRows.append(dictBinding)
+        return listRows
 
-        logger.debug(self.dictSPARQLResults)
+    @staticmethod
+    def __tableValue(dictValue: dict):
+        """A SPARQL JSON result value as a cell: IRIs and literals as strings, XSD booleans and numbers converted"""
+        if dictValue.get('type', None) not in SPARQLTransformer._RDF_VALUE_TYPES:
+            return None
+        strValue = dictValue.get('value', None)
+        strDatatype = dictValue.get('datatype', None)
+        if not strDatatype:
+            return strValue
+        try:
+            if strDatatype in XSD.XSD_BOOLEAN_TYPES:
+                return strValue not in ['false', '0']
+            if strDatatype in XSD.XSD_INT_TYPES:
+                return int(strValue)
+            if strDatatype in XSD.XSD_FLOAT_TYPES:
+                return float( strValue.replace('INF', 'inf') )
+        except ValueError:
+            pass
+        return strValue
 
-        # Process raw self.dictSPARQLResults into self.objResults...
-        self.__postProcess()
-        return self.objResults # list or dict
+    @staticmethod
+    def __columnType(listValues: list) -> tuple[type | None, bool]:
+        """Get the type of a column (int, float, bool or None for any other) and whether it has missing values"""
+        setTypes = { type(objValue) for objValue in listValues if objValue is not None }
+        bMissing = len(setTypes) == 0 or any( objValue is None for objValue in listValues )
+        if setTypes == {bool}:
+            return (bool, bMissing)
+        if setTypes == {int}:
+            return (int, bMissing)
+        if setTypes and setTypes <= {int, float}:
+            return (float, bMissing)
+        return (None, bMissing)
+
+    def __query(self, dictConditional: dict | None = None, fDeadline: float | None = None):
+        # The 'timeout' (seconds) or 'deadline' (a time.monotonic() value) bounds the whole transform.
+        # When it is reached, the results are the objects fully assembled so far, and bTruncated is set...
+        if fDeadline is None:
+            fDeadline = self.dictOptions.get('deadline', None)
+        if fDeadline is None and self.dictOptions.get('timeout', None) is not None:
+            fDeadline = time.monotonic() + self.dictOptions['timeout']
+        objRun = TransformRun(fDeadline)
+
+        self.__compile()
+
+        funcSPAQRLQuery = self.dictOptions['sparqlFunction'] if 'sparqlFunction' in self.dictOptions else self.__defaultSPARQLQuery(objRun, dictConditional)
+        objRun.dictSPARQLResults = self.__executeQueries(funcSPAQRLQuery, objRun)
+
+        self.logger.debug(objRun.dictSPARQLResults)
+        return objRun
+
+    def __compile(self):
+        # The query is compiled (and its file read) only once...
+        if self.bCompiled:
+            return
+        with self.lockCompile:
+            if not self.bCompiled:
+                self.__preProcess()
 
     def __preProcess(self):
         if isinstance(self.objQuery, str):
@@ -125,7 +437,9 @@ class SPARQLTransformer:
         if '@context' in self.dictJSONQuery:
             self.dictOptions['context'] = self.dictJSONQuery['@context']
 
-        logger.debug('OPTIONS:\n' + pprint.pformat(self.dictOptions))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            import pprint
+            self.logger.debug('OPTIONS:\n' + pprint.pformat(self.dictOptions))
 
         # Save info for "hideLang" before it is destroyed...
         if '$langTag' in self.dictJSONQuery:
@@ -137,48 +451,545 @@ class SPARQLTransformer:
         self.dictOptions['voc'] = objVocab
 
         self.__createSPARQLQuery()
+        self.bCompiled = True
+        return
 
-        if '$limitMode' in self.dictJSONQuery and '$limit' in self.dictJSONQuery:
-            self.dictOptions['limit'] = self.dictJSONQuery['$limit']
-            self.dictOptions['offset'] = self.dictJSONQuery.get('$offset', 0)
 
-        return
+    def __executeQueries(self, funcSPARQLQuery: Callable, objRun) -> dict:
+        """Run the SPARQL query (or its VALUES chunks) and gather all the bindings in a single result"""
+        dictNoResults = { 'head': {}, 'results': { 'bindings': [] } }
+        if len(self.listSPARQLQueries) == 1:
+            try:
+                return funcSPARQLQuery(self.listSPARQLQueries[0])
+            except Exception:
+                if not objRun.isExpired():
+                    raise
+                logger.warning('WARNING: Deadline reached while querying, no results!')
+                objRun.bTruncated = True
+                return dictNoResults
+
+        # Run the chunks concurrently on a shared worker pool...
+        import concurrent.futures
+        executor = self.dictOptions.get('executor', None) or _sharedThreadPool( self.dictOptions.get('maxWorkers', 4) )
+        listFutures = [ executor.submit(funcSPARQLQuery, strQuery) for strQuery in self.listSPARQLQueries ]
+        concurrent.futures.wait(listFutures, timeout=objRun.remaining())
+
+        # NOTE: The chunks are gathered in order, so the bindings are the ones a single query would return...
+        listChunkResults = []
+        for future in listFutures:
+            if future.done() and not future.cancelled() and ( future.exception() is None or not objRun.isExpired() ):
+                listChunkResults.append( future.result() ) # ...raise the errors before the deadline
+            else:
+                future.cancel()
+                objRun.bTruncated = True
+        if objRun.bTruncated:
+            logger.warning('WARNING: Deadline reached while querying, %d of %d chunks missing!' % (
+                len(listFutures) - len(listChunkResults), len(listFutures) ))
+        if not listChunkResults:
+            return dictNoResults
+
+        listBindings = []
+        for dictChunkResult in listChunkResults:
+            listBindings.extend(dictChunkResult['results']['bindings'])
+
+        # A DISTINCT query only drops the duplicates within each chunk: without an anchor to merge them,
+        # drop the duplicates across the chunks, as a single query would...
+        if '$anchor' not in self.dictProperties and re.search(r'\bSELECT\s+DISTINCT\b', self.listSPARQLQueries[0], re.IGNORECASE):
+            setSeen = set()
+            listUnique = []
+            for dictBinding in listBindings:
+                tupleKey = tuple( sorted( (strVar, _packBindingValue(dictValue)) for strVar, dictValue in dictBinding.items() ) )
+                if tupleKey not in setSeen:
+                    setSeen.add(tupleKey)
+                    listUnique.append(dictBinding)
+            listBindings = listUnique
+        return {
+            'head': listChunkResults[0].get('head', {}),
+            'results': { 'bindings': listBindings }
+        }
 
 
-    def __postProcess(self):
-        isJSONLD = self.dictOptions['is_json_ld']
+    def __postProcess(self, objRun):
+        listBindings = self.__dedupBindings(objRun.dictSPARQLResults['results']['bindings'], objRun)
+        iProcesses = self.dictOptions.get('processes', None)
+        strAnchorVar = self.__anchorVariable()
 
-        # Process bindings into self.listResults...
-        self.__processBindings( self.dictSPARQLResults['results']['bindings'] )
+        listFirstRows = None
+        if iProcesses and iProcesses > 1 and strAnchorVar and len(listBindings) > iProcesses:
+            # Fit and merge in worker processes, sharding by anchor...
+            listProcessedResults = self.__processShards(listBindings, strAnchorVar, iProcesses, objRun)
+        else:
+            # Process bindings into listResults...
+            listResults = self.__processBindings(listBindings, objRun.fDeadline)
+            iFitted = len(listResults)
+
+            # Merge lines with the same ID...
+            listProcessedResults, listFirstRows = self.__mergeResults(listResults)
+
+            # Out of time: keep only the objects without bindings left to fit...
+            if iFitted < len(listBindings):
+                logger.warning('WARNING: Deadline reached, %d of %d results fitted!' % (iFitted, len(listBindings)))
+                objRun.bTruncated = True
+                if strAnchorVar:
+                    setPending = { SPARQLTransformer.__bindingAnchorKey(dictBinding, strAnchorVar) for dictBinding in listBindings[iFitted:] }
+                    listProcessedResults = [
+                        dictResult for dictResult, iFirst in zip(listProcessedResults, listFirstRows)
+                        if SPARQLTransformer.__bindingAnchorKey(listBindings[iFirst], strAnchorVar) not in setPending
+                    ]
+
+        # Remove anchor tag (flattening keeps them to find the objects)...
+        if not self.dictOptions.get('flatten', False):
+            for item in listProcessedResults:
+                SPARQLTransformer.__recursiveClean(item)
+
+        # Index the merged results by anchor for update(), when asked, without fitting them again...
+        if self.dictOptions.get('indexAnchors', False) and not objRun.bTruncated and listFirstRows is not None:
+            objRun.dictAnchorIndex = self.__indexResults(
+                objRun.dictSPARQLResults['results']['bindings'], listBindings, listProcessedResults, listFirstRows, strAnchorVar
+            )
+
+        objRun.objResults = self.__finalizeResults(listProcessedResults)
 
-        # Merge lines with the same ID...
-        listProcessedResults = []
-        strAnchorKey = self.listResults[0]['$anchor'] if (len(self.listResults) > 0 and '$anchor' in self.listResults[0]) else None
-        if not strAnchorKey:
-            listProcessedResults = self.listResults
-        else: # Process anchor...
-            for dictResult in self.listResults:
-                strID = dictResult[strAnchorKey]
-                # Search for same ID..
-                listMatch = [dictPR for dictPR in listProcessedResults if dictPR[strAnchorKey] == strID]
-                if not listMatch:  # ...add a new one...
-                    listProcessedResults.append(dictResult)
-                else:  # Otherwise, modify the previous one...
-                    SPARQLTransformer.__mergeObject(listMatch[0], dictResult)
-
-        # Remove anchor tag...
-        for item in listProcessedResults:
-            SPARQLTransformer.__recursiveClean(item)
 
+    def __finalizeResults(self, listProcessedResults: list):
+        """Apply the library limit and wrap the merged results"""
         if 'limit' in self.dictOptions:
             listProcessedResults = listProcessedResults[self.dictOptions['offset']: self.dictOptions['offset'] + self.dictOptions['limit']]
+        if self.dictOptions.get('flatten', False):
+            listProcessedResults = SPARQLTransformer.__flattenResults(listProcessedResults)
 
-        self.objResults = listProcessedResults
-        if isJSONLD:
-            self.objResults = {
+        if self.dictOptions['is_json_ld']:
+            return {
                 '@context': self.dictOptions['context'],
                 '@graph': listProcessedResults
             }
+        return listProcessedResults
+
+
+    def __spillProcess(self, objRun, funcWriter: Callable):
+        """ Fit the bindings by batches, spilling each batch sorted by anchor to a temporary file,
+            then k-way merge the files and merge each anchor group as it completes.
+            The bindings are released as their batch is taken, so beyond the query response only a batch
+            of fitted results, a digest per distinct binding and a group per file are held in memory.
+        """
+        import tempfile
+        import hashlib
+        listBindings = objRun.dictSPARQLResults['results']['bindings']
+        objRun.dictSPARQLResults = None # ...the results are not kept
+        # NOTE: The answers of a 'sparqlFunction' may be held by the caller, so they are left untouched...
+        bRelease = 'sparqlFunction' not in self.dictOptions
+        iSpillRows = self.dictOptions.get('spillRows', None) or 100000
+        strAnchorKey = self.dictProperties.get('$anchor', None)
+        strAnchorVar = self.__anchorVariable()
+        # The best languages are those of all the bindings, not of a batch...
+        dictBest = self.__bestLanguages(listBindings) if self.dictOptions.get('bestlang', None) else None
+
+        # Take the bindings a batch at a time, dropping the duplicates as __dedupBindings() does...
+        bDedup = '$anchor' in self.dictProperties
+        listVars = self.__fitVariables()
+        setSeen = set()
+        def nextBatch(iNext):
+            listBatch = []
+            while iNext < len(listBindings) and len(listBatch) < iSpillRows:
+                dictBinding = listBindings[iNext]
+                if bRelease:
+                    listBindings[iNext] = None
+                iNext += 1
+                if bDedup:
+                    tupleKey = tuple( _packBindingValue( dictBinding.get(strVar, None) ) for strVar in listVars )
+                    bytesKey = hashlib.blake2b( repr(tupleKey).encode(), digest_size=16 ).digest()
+                    if bytesKey in setSeen:
+                        objRun.iSkippedRows += 1
+                        continue
+                    setSeen.add(bytesKey)
+                listBatch.append(dictBinding)
+            return listBatch, iNext
+
+        # Write through the library limit...
+        bLimit = 'limit' in self.dictOptions
+        iOffset = self.dictOptions.get('offset', 0) if bLimit else 0
+        iEnd = iOffset + self.dictOptions['limit'] if bLimit else None
+        objRun.iResults = 0
+        iSeen = 0
+        def emit(dictResult):
+            SPARQLTransformer.__recursiveClean(dictResult)
+            funcWriter(dictResult)
+            objRun.iResults += 1
+        def write(dictResult):
+            nonlocal iSeen
+            if iEnd is None or iSeen < iEnd:
+                if iSeen >= iOffset:
+                    emit(dictResult)
+            iSeen += 1
+        # NOTE: The groups come out in anchor order, so the limit picks them by the order their anchors are
+        #       first seen, as transform() does: the binding anchor of each group, in first-seen order...
+        dictFirstSeen = {} if bLimit and strAnchorKey else None
+
+        with tempfile.TemporaryDirectory(dir=self.dictOptions.get('tempDir', None)) as strTempDir:
+            listRunPaths = []
+            iNext = 0
+            iFitted = 0
+            listLeft = []
+            while iNext < len(listBindings):
+                listBatch, iNext = nextBatch(iNext)
+                listResults = self.__processBindings(listBatch, objRun.fDeadline, dictBest)
+                if not strAnchorKey: # ...nothing to merge
+                    for dictResult in listResults:
+                        write(dictResult)
+                else:
+                    # Each record keeps the anchor of its binding, to leave out the groups with bindings left to fit...
+                    listRecords = sorted(
+                        ( (SPARQLTransformer.__anchorHashKey( dictResult.get(strAnchorKey, None) ), iFitted + iRow,
+                           SPARQLTransformer.__bindingAnchorKey(listBatch[iRow], strAnchorVar) if strAnchorVar else None, dictResult)
+                          for iRow, dictResult in enumerate(listResults) ),
+                        key=lambda tupleRecord: tupleRecord[:2]
+                    )
+                    strRunPath = os.path.join(strTempDir, 'run%d' % len(listRunPaths))
+                    _writeRun(strRunPath, listRecords)
+                    listRunPaths.append(strRunPath)
+                    if dictFirstSeen is not None:
+                        for strKey, iRow, strBindingAnchor, _dictResult in listRecords:
+                            dictFirstSeen.setdefault(strKey, (iRow, strBindingAnchor))
+                    del listRecords
+                iFitted += len(listResults)
+                if len(listResults) < len(listBatch):
+                    listLeft = listBatch[len(listResults):]
+                    break
+                del listResults, listBatch
+
+            # Out of time: leave out the objects with bindings left to fit...
+            setPending = set()
+            if listLeft or iNext < len(listBindings):
+                logger.warning('WARNING: Deadline reached, %d results fitted, %d bindings left!' % (
+                    iFitted, len(listLeft) + len(listBindings) - iNext ))
+                objRun.bTruncated = True
+                if strAnchorVar:
+                    setPending = { SPARQLTransformer.__bindingAnchorKey(dictBinding, strAnchorVar)
+                                   for dictBinding in itertools.chain(listLeft, listBindings[iNext:]) }
+            if bRelease:
+                del listBindings[:]
+            del listLeft
+
+            # The groups within the limit, among those left after the deadline...
+            setWrite = None
+            if dictFirstSeen is not None:
+                listKeys = [
+                    strKey for strKey, (_iRow, strBindingAnchor) in sorted( dictFirstSeen.items(), key=lambda tupleItem: tupleItem[1][0] )
+                    if not ( strAnchorVar and strBindingAnchor in setPending )
+                ]
+                setWrite = set( listKeys[iOffset: iEnd] )
+                del listKeys, dictFirstSeen
+
+            # Merge the runs, a group of results with the same anchor at a time...
+            def writeGroup(strKey, dictGroup, strBindingAnchor):
+                if strAnchorVar and strBindingAnchor in setPending:
+                    return
+                if setWrite is None:
+                    write(dictGroup)
+                elif strKey in setWrite:
+                    emit(dictGroup)
+            strGroupKey, strGroupAnchor, dictGroup = None, None, None
+            for strKey, _iRow, strBindingAnchor, dictResult in heapq.merge( *[ _readRun(strRunPath) for strRunPath in listRunPaths ], key=lambda tupleRecord: tupleRecord[:2] ):
+                if dictGroup is not None and strKey == strGroupKey:
+                    SPARQLTransformer.__mergeObject(dictGroup, dictResult)
+                    continue
+                if dictGroup is not None:
+                    writeGroup(strGroupKey, dictGroup, strGroupAnchor)
+                strGroupKey, strGroupAnchor, dictGroup = strKey, strBindingAnchor, dictResult
+            if dictGroup is not None:
+                writeGroup(strGroupKey, dictGroup, strGroupAnchor)
+
+
+    @staticmethod
+    def __flattenResults(listResults: list) -> list:
+        """ Flatten the merged results into a graph: each anchored object once, referenced elsewhere by its anchor.
+            Return cleaned copies of the results followed by the nested objects, in first-seen order.
+        """
+        dictGraph = {}
+        dictVisited = {}
+
+        def flatten(objItem):
+            if isinstance(objItem, list):
+                return [ flatten(item) for item in objItem ]
+            if not isinstance(objItem, dict):
+                return objItem
+            if id(objItem) in dictVisited: # ...a shared object
+                return dictVisited[id(objItem)]
+            dictCopy = { strKey: flatten(item) for strKey, item in objItem.items() if strKey not in ('$anchor', '$asList') }
+            strAnchorKey = objItem.get('$anchor', None)
+            if not strAnchorKey or strAnchorKey not in objItem: # ...no anchor value, kept nested
+                return dictCopy
+            dictRef = { strAnchorKey: objItem[strAnchorKey] }
+            dictVisited[id(objItem)] = dictRef
+            objID = SPARQLTransformer.__anchorHashKey(objItem[strAnchorKey])
+            if objID in dictGraph:
+                SPARQLTransformer.__mergeObject(dictGraph[objID], dictCopy)
+            else:
+                dictGraph[objID] = dictCopy
+            return dictRef
+
+        listRoots = []
+        setRootIDs = set()
+        for dictResult in listResults:
+            objFlat = flatten(dictResult)
+            strAnchorKey = dictResult.get('$anchor', None)
+            if strAnchorKey and strAnchorKey in dictResult:
+                objID = SPARQLTransformer.__anchorHashKey(dictResult[strAnchorKey])
+                if objID in setRootIDs:
+                    continue
+                setRootIDs.add(objID)
+                objFlat = dictGraph[objID]
+            listRoots.append(objFlat)
+        return listRoots + [ dictNode for objID, dictNode in dictGraph.items() if objID not in setRootIDs ]
+
+
+    def update(self, objBase, listAdded: list | None = None, listRemoved: list | None = None, listBindings: list | None = None):
+        """ Incrementally re-transform against a previous result, a TransformRun (of run() or update()) or its 'dictAnchorIndex'.
+            Either give the new full bindings (listBindings), or only the added and removed ones.
+            Only the anchor groups touched by the change are fitted and merged again.
+            Runs are indexed by anchor with the 'indexAnchors' option: for the others, the first update() fits every group again.
+            Return a TransformRun with the results and their index, and a dict listing the 'added', 'changed' and 'removed' anchor values.
+            NOTE: The results share their objects with the index, and so with the next updates: copy them before changing them.
+        """
+        self.__compile()
+        strAnchorVar = self.__anchorVariable()
+
+        if isinstance(objBase, TransformRun):
+            if objBase.dictAnchorIndex is None:
+                if objBase.dictSPARQLResults is None:
+                    raise ValueError('update() requires a run with its bindings or an anchor index')
+                objBase.dictAnchorIndex = self.__buildAnchorIndex(objBase.dictSPARQLResults['results']['bindings'], strAnchorVar)
+            dictAnchorIndex = objBase.dictAnchorIndex
+        else:
+            dictAnchorIndex = objBase
+
+        # Group the changed bindings by anchor...
+        dictNewIndex = {}
+        setTouched = set()
+        if listBindings is not None:
+            for dictBinding in listBindings:
+                objKey = SPARQLTransformer.__bindingAnchorKey(dictBinding, strAnchorVar)
+                dictNewIndex.setdefault(objKey, { 'bindings': [], 'results': None })['bindings'].append(dictBinding)
+            for objKey, dictGroup in dictNewIndex.items():
+                dictOldGroup = dictAnchorIndex.get(objKey, None)
+                if dictOldGroup is not None and SPARQLTransformer.__sameBindings(dictOldGroup['bindings'], dictGroup['bindings']):
+                    dictGroup['results'] = dictOldGroup['results']
+                else:
+                    setTouched.add(objKey)
+        else:
+            dictNewIndex = { objKey: dict(dictGroup) for objKey, dictGroup in dictAnchorIndex.items() }
+            for dictBinding in (listRemoved or []):
+                objKey = SPARQLTransformer.__bindingAnchorKey(dictBinding, strAnchorVar)
+                dictGroup = dictNewIndex.get(objKey, None)
+                if dictGroup is None:
+                    continue
+                strBinding = dumps(dictBinding, sort_keys=True)
+                listGroupBindings = list(dictGroup['bindings'])
+                for iBinding, dictGroupBinding in enumerate(listGroupBindings):
+                    if dumps(dictGroupBinding, sort_keys=True) == strBinding:
+                        listGroupBindings.pop(iBinding)
+                        break
+                dictGroup['bindings'] = listGroupBindings
+                setTouched.add(objKey)
+            for dictBinding in (listAdded or []):
+                objKey = SPARQLTransformer.__bindingAnchorKey(dictBinding, strAnchorVar)
+                dictGroup = dictNewIndex.setdefault(objKey, { 'bindings': [], 'results': None })
+                dictGroup['bindings'] = dictGroup['bindings'] + [dictBinding]
+                setTouched.add(objKey)
+            for objKey in list(setTouched):
+                if not dictNewIndex[objKey]['bindings']:
+                    dictNewIndex.pop(objKey)
+
+        # Fit and merge only the touched groups...
+        dictChanges = { 'added': [], 'changed': [], 'removed': [] }
+        for objKey in dictAnchorIndex:
+            if objKey not in dictNewIndex:
+                dictChanges['removed'].append(objKey)
+        for objKey, dictGroup in dictNewIndex.items():
+            if objKey not in setTouched:
+                continue
+            dictGroup['results'] = self.__fitGroup(dictGroup['bindings'])
+            dictChanges['added' if objKey not in dictAnchorIndex else 'changed'].append(objKey)
+
+        objRun = TransformRun()
+        objRun.dictAnchorIndex = dictNewIndex
+        objRun.objResults = self.__finalizeResults( [ dictResult for dictGroup in dictNewIndex.values() for dictResult in dictGroup['results'] ] )
+        return objRun, dictChanges
+
+
+    def __buildAnchorIndex(self, listBindings: list, strAnchorVar: str | None) -> dict:
+        """Group the bindings by anchor value, with the results fitted and merged for each group"""
+        dictAnchorIndex = {}
+        for dictBinding in listBindings:
+            objKey = SPARQLTransformer.__bindingAnchorKey(dictBinding, strAnchorVar)
+            dictAnchorIndex.setdefault(objKey, { 'bindings': [], 'results': None })['bindings'].append(dictBinding)
+        for dictGroup in dictAnchorIndex.values():
+            dictGroup['results'] = self.__fitGroup(dictGroup['bindings'])
+        return dictAnchorIndex
+
+
+    def __indexResults(self, listAllBindings: list, listBindings: list, listProcessedResults: list, listFirstRows: list,
+                       strAnchorVar: str | None) -> dict:
+        """ Group all the bindings by anchor value, with the merged results of each group, as __buildAnchorIndex()
+            does, but from the results of a run (listFirstRows indexing the fitted listBindings) rather than fitting them again
+        """
+        dictAnchorIndex = {}
+        for dictBinding in listAllBindings:
+            objKey = SPARQLTransformer.__bindingAnchorKey(dictBinding, strAnchorVar)
+            dictAnchorIndex.setdefault(objKey, { 'bindings': [], 'results': [] })['bindings'].append(dictBinding)
+        for dictResult, iFirst in zip(listProcessedResults, listFirstRows):
+            dictAnchorIndex[ SPARQLTransformer.__bindingAnchorKey(listBindings[iFirst], strAnchorVar) ]['results'].append(dictResult)
+        return dictAnchorIndex
+
+
+    def __fitGroup(self, listBindings: list) -> list:
+        listProcessedResults, _listFirstRows = self.__mergeResults( self.__processBindings( self.__dedupBindings(listBindings) ) )
+        if not self.dictOptions.get('flatten', False):
+            for item in listProcessedResults:
+                SPARQLTransformer.__recursiveClean(item)
+        return listProcessedResults
+
+
+    @staticmethod
+    def __bindingAnchorKey(dictBinding: dict, strAnchorVar: str | None):
+        """The anchor value of a binding or, without an anchor, the whole binding"""
+        if strAnchorVar is None:
+            return dumps(dictBinding, sort_keys=True)
+        dictAnchor = dictBinding.get(strAnchorVar, None)
+        return dictAnchor['value'] if dictAnchor else None
+
+
+    @staticmethod
+    def __sameBindings(listBindingsA: list, listBindingsB: list) -> bool:
+        if len(listBindingsA) != len(listBindingsB):
+            return False
+        return all(
+            dictA == dictB or dumps(dictA, sort_keys=True) == dumps(dictB, sort_keys=True)
+            for dictA, dictB in zip(listBindingsA, listBindingsB)
+        )
+
+
+    def __dedupBindings(self, listBindings: list, objRun=None) -> list:
+        """ Drop the bindings equal to a previous one on the variables used by the prototype.
+            Merged by anchor, they would add nothing, so they are only dropped when there is an anchor.
+        """
+        if '$anchor' not in self.dictProperties:
+            return listBindings
+        listVars = self.__fitVariables()
+        setSeen = set()
+        listUnique = []
+        for dictBinding in listBindings:
+            tupleKey = tuple( _packBindingValue( dictBinding.get(strVar, None) ) for strVar in listVars )
+            if tupleKey not in setSeen:
+                setSeen.add(tupleKey)
+                listUnique.append(dictBinding)
+        if objRun is not None:
+            objRun.iSkippedRows += len(listBindings) - len(listUnique)
+        return listUnique
+
+
+    def __fitVariables(self) -> list:
+        """Get the SPARQL variables used by the prototype"""
+        if self.listFitVars is None:
+            self.listFitVars = SPARQLTransformer.__collectVariables(self.dictProperties)
+        return self.listFitVars
+
+
+    @staticmethod
+    def __collectVariables(objItem) -> list:
+        """Get the SPARQL variables in a (compiled) prototype"""
+        dictVars = {}
+        listItems = [objItem]
+        while listItems:
+            objItem = listItems.pop()
+            if isinstance(objItem, dict):
+                listItems.extend( objItem.values() )
+            elif isinstance(objItem, list):
+                listItems.extend(objItem)
+            elif isinstance(objItem, str) and objItem.startswith('?'):
+                dictVars[ objItem[1:].split('$')[0] ] = None
+        return list(dictVars)
+
+
+    def __mergeResults(self, listResults: list) -> tuple[list, list]:
+        """ Merge the fitted results with the same anchor, keeping the order they are first seen.
+            Return the merged results and, for each one, the index of the result that started it.
+        """
+        strAnchorKey = listResults[0]['$anchor'] if (len(listResults) > 0 and '$anchor' in listResults[0]) else None
+        if not strAnchorKey:
+            return listResults, list( range( len(listResults) ) )
+
+        # Process anchor...
+        listProcessedResults = []
+        listFirstRows = []
+        dictAnchorIndex = {}
+        for iRow, dictResult in enumerate(listResults):
+            objID = SPARQLTransformer.__anchorHashKey( dictResult.get(strAnchorKey, None) )
+            # Search for same ID...
+            iMatch = dictAnchorIndex.get(objID, None)
+            if iMatch is None:  # ...add a new one...
+                dictAnchorIndex[objID] = len(listProcessedResults)
+                listProcessedResults.append(dictResult)
+                listFirstRows.append(iRow)
+            else:  # Otherwise, modify the previous one...
+                SPARQLTransformer.__mergeObject(listProcessedResults[iMatch], dictResult)
+        return listProcessedResults, listFirstRows
+
+
+    def __anchorVariable(self) -> str | None:
+        """Get the name of the SPARQL variable holding the root anchor, if any"""
+        strAnchorKey = self.dictProperties.get('$anchor', None)
+        objAnchor = self.dictProperties.get(strAnchorKey, None) if strAnchorKey else None
+        if not ( isinstance(objAnchor, str) and objAnchor.startswith('?') ):
+            return None
+        return objAnchor[1:].split('$')[0]
+
+
+    def __processShards(self, listBindings: list, strAnchorVar: str, iProcesses: int, objRun) -> list:
+        """ Fit and merge the bindings in a pool of processes.
+            Bindings are sharded by a hash of the anchor value, so every anchor is merged by a single worker,
+            and sent in a compact columnar form. The merged shards are then gathered in first-seen order.
+        """
+        listVars = list( { strVar: None for dictBinding in listBindings for strVar in dictBinding } )
+        listShards = [ [] for _ in range(iProcesses) ]
+        for iRow, dictBinding in enumerate(listBindings):
+            dictAnchor = dictBinding.get(strAnchorVar, None)
+            iShard = zlib.crc32( dictAnchor['value'].encode() ) % iProcesses if dictAnchor else 0
+            listShards[iShard].append( (iRow, tuple( _packBindingValue( dictBinding.get(strVar, None) ) for strVar in listVars )) )
+
+        dictFitOptions = { strKey: self.dictOptions[strKey] for strKey in SPARQLTransformer._FIT_OPTIONS if strKey in self.dictOptions }
+        import concurrent.futures.process
+        executor = self.dictOptions.get('processExecutor', None) or _sharedProcessPool(iProcesses)
+        listFutures = [
+            executor.submit(_processShard, self.dictProperties, dictFitOptions, listVars, listRows)
+            for listRows in listShards if listRows
+        ]
+        setDone, setPending = concurrent.futures.wait(listFutures, timeout=objRun.remaining())
+
+        # Out of time: each shard holds whole anchors, so keep the finished ones...
+        if setPending:
+            logger.warning('WARNING: Deadline reached, %d of %d shards merged!' % (len(setDone), len(listFutures)))
+            objRun.bTruncated = True
+            for future in setPending:
+                future.cancel() # ...the running ones end in the background, the pool is kept
+        try:
+            listShardResults = [ future.result() for future in listFutures if future in setDone ]
+        except concurrent.futures.process.BrokenProcessPool:
+            _discardProcessPool(executor) # ...a worker died: the next transform starts a new pool
+            raise
+
+        # Each shard is already in first-seen order...
+        return [ dictResult for _iRow, dictResult in heapq.merge( *listShardResults, key=lambda tupleResult: tupleResult[0] ) ]
+
+
+    def _fitShard(self, listVars: list, listRows: list) -> list[tuple[int, dict]]:
+        """Fit and merge a shard of packed bindings, returning each merged result with its first row index"""
+        listBindings = [
+            { strVar: _unpackBindingValue(tupleValue) for strVar, tupleValue in zip(listVars, tupleRow) if tupleValue is not None }
+            for _iRow, tupleRow in listRows
+        ]
+        listProcessedResults, listFirstRows = self.__mergeResults( self.__processBindings(listBindings) )
+        return [ (listRows[iFirst][0], dictResult) for iFirst, dictResult in zip(listFirstRows, listProcessedResults) ]
 
 
     def __createSPARQLQuery(self):
@@ -245,6 +1056,8 @@ class SPARQLTransformer:
         if type(listFilters) is not list:
             listFilters = [listFilters]
         strLangPrimary = dictModifiers.get('$lang')
+        # Portable $bestlang: the best language is chosen while fitting, instead of by sql:BEST_LANGMATCH...
+        dictBestlangs = {} if dictModifiers.get('$bestlangMode', self.dictOptions.get('bestlangMode', None)) == 'portable' else None
 
         # Process additional WHERE clause entries from Graph Body Properties:
         # 1. For SELECT, create variables (listVars)
@@ -252,17 +1065,22 @@ class SPARQLTransformer:
         # NOTE: Currently, listFilters is unused but could be used if there is a need to calculate
         #       additional filters to add to listFilters
         funcWhere, _UNUSEDBlockRequired = SPARQLTransformer.__processProperties(
-                self.dictProperties, listVars, dictValuesNorm, listWheres, listFilters, strLangPrimary
+                self.dictProperties, listVars, dictValuesNorm, listWheres, listFilters, strLangPrimary,
+                dictBestlangs=dictBestlangs
             )
         for index, key in enumerate( list(self.dictProperties) ):
             funcWhere(key, index)
+        if dictBestlangs:
+            self.dictOptions['bestlang'] = dictBestlangs
 
         # Variables...
         qVars = ' '.join(listVars)
 
         # Values...
+        # NOTE: Large VALUES lists are split into chunks, one query per chunk...
         bValuesExist = (dictValues != None)
-        qValues = ('\n'+INDENT).join(self.__parseValues(dictValuesNorm, dictPrefixes)) if bValuesExist else ''
+        listValuesChunks = self.__chunkValues(dictValuesNorm) if bValuesExist else []
+        qValues = _VALUES_TOKEN if bValuesExist else ''
 
         # WHERE Clauses...
         modEntry = []
@@ -283,6 +1101,9 @@ class SPARQLTransformer:
         modEntry = dictModifiers.get('$groupby', None)
         if modEntry and type(modEntry) is not list:
             modEntry = [modEntry]
+        # Concatenated properties need all the other variables grouped...
+        if not modEntry and any(strVar.startswith('(GROUP_CONCAT(') for strVar in listVars):
+            modEntry = [strVar for strVar in listVars if strVar.startswith('?')]
         qGroupBy = ('GROUP BY ' + ' '.join(modEntry)) if (modEntry) else ''
 
         modEntry = dictModifiers.get('$having', None)
@@ -296,14 +1117,22 @@ class SPARQLTransformer:
         qOrderBy = ('ORDER BY ' + ' '.join(modEntry)) if (modEntry) else ''
 
         modEntry = dictModifiers.get('$limit', None)
-        bNotLibLimitMode = (dictModifiers.get('$limitMode', '') != 'library')
+        # NOTE: A LIMIT or OFFSET can not be split across chunked queries, nor count the objects when all the
+        #       languages of a portable $bestlang are queried, so the library applies it...
+        bNotLibLimitMode = (dictModifiers.get('$limitMode', '') != 'library') and len(listValuesChunks) < 2 and not dictBestlangs
         qLimit = ('LIMIT %d' % modEntry) if (modEntry and bNotLibLimitMode) else ''
+        if modEntry and not bNotLibLimitMode:
+            self.dictOptions['limit'] = modEntry
+            self.dictOptions['offset'] = dictModifiers.get('$offset', 0)
 
         modEntry = dictModifiers.get('$offset', None)
         qOffset = ('OFFSET %d' % modEntry) if (modEntry and bNotLibLimitMode) else ''
 
+        if len(listValuesChunks) > 1 and (qGroupBy or qOrderBy):
+            logger.warning('WARNING: GROUP BY and ORDER BY apply to each VALUES chunk, not to the whole result!')
+
         # Assemble the query...
-        self.strSPARQLQuery = """%s
+        strSPARQLQuery = """%s
 SELECT %s %s
 %s
 %s
@@ -323,13 +1152,44 @@ WHERE {
             qValues, qWheres, qFilters,
             qGroupBy, qHaving, qOrderBy, qLimit, qOffset )
 
-        self.strSPARQLQuery = re.sub(r"\n+", "\n", self.strSPARQLQuery) # ...reduce multiple newlines (blank lines) to one
-        self.strSPARQLQuery = re.sub(r"\n\s+\n", "\n", self.strSPARQLQuery) # ...remove any other blank lines
-        self.strSPARQLQuery = re.sub(r"\.+", ".", self.strSPARQLQuery) # ...reduce multiple periods to one
-        logger.info("Query:\n" + self.strSPARQLQuery)
+        strSPARQLQuery = re.sub(r"\n+", "\n", strSPARQLQuery) # ...reduce multiple newlines (blank lines) to one
+        strSPARQLQuery = re.sub(r"\n\s+\n", "\n", strSPARQLQuery) # ...remove any other blank lines
+        strSPARQLQuery = re.sub(r"\.+", ".", strSPARQLQuery) # ...reduce multiple periods to one
+
+        # Fill in the VALUES after the cleanup so the values themselves are left untouched...
+        if bValuesExist:
+            self.listSPARQLQueries = [
+                strSPARQLQuery.replace( _VALUES_TOKEN, ('\n'+INDENT).join(self.__parseValues(dictChunk, dictPrefixes)) )
+                for dictChunk in listValuesChunks
+            ]
+        else:
+            self.listSPARQLQueries = [strSPARQLQuery]
+        self.strSPARQLQuery = self.listSPARQLQueries[0] # ...the first (or only) query
+        self.logger.info("Query:\n" + self.strSPARQLQuery)
+        if len(self.listSPARQLQueries) > 1:
+            self.logger.info('Query split in %d VALUES chunks' % len(self.listSPARQLQueries))
         return
 
 
+    def __chunkValues(self, dictValues: dict) -> list[dict]:
+        """Split the VALUES lists longer than the 'valuesChunkSize' option into a list of smaller VALUES sets"""
+        iChunkSize = self.dictOptions.get('valuesChunkSize', None)
+        if not iChunkSize:
+            return [dictValues]
+
+        listChunkedValues = []
+        for strKey, objValue in dictValues.items():
+            if type(objValue) is list and len(objValue) > iChunkSize:
+                listChunkedValues.append(
+                    [ (strKey, objValue[iStart : iStart + iChunkSize]) for iStart in range(0, len(objValue), iChunkSize) ]
+                )
+            else:
+                listChunkedValues.append( [ (strKey, objValue) ] )
+
+        # Every combination of chunks, so the union of the chunked queries is the single query...
+        return [ dict(tupleChunk) for tupleChunk in itertools.product(*listChunkedValues) ]
+
+
     def __normalizeValues(self, dictValues: dict | None) -> dict:
         """Transform all keys of a object to a SPARQL variable"""
         if dictValues is None:
@@ -337,100 +1197,204 @@ WHERE {
         dictNormValues = dict()
         for strKey, strValue in dictValues.items():
             if (strValue):
-                dictNormValues[ SPARQLTransformer.__makeSPARQLVariable(strKey) ] = strValue
+                strNormKey = ' '.join( map(SPARQLTransformer.__makeSPARQLVariable, strKey.split()) )
+                dictNormValues[strNormKey] = strValue
         return dictNormValues
 
 
-    def __defaultSPARQLQuery(self) -> Callable :
-        sparql = SPARQLWrapper(self.dictOptions['endpoint'])
-        sparql.setReturnFormat(JSON)
-
-        def executeQuery(strQuery):
+    def __defaultSPARQLQuery(self, objRun, dictConditional: dict | None = None) -> Callable :
+        """ Get the function querying the endpoint. With dictConditional, the validators of the cached answers
+            by query, the requests are conditional: a query answered 304 Not Modified is recorded in the run
+            (with no bindings). The validators of the answers are recorded in the run.
+        """
+        from SPARQLWrapper import SPARQLWrapper, JSON
+        import urllib.error
+        objEndpoint = self.dictOptions['endpoint']
+        scheduler = self.dictOptions.get('scheduler', None)
+        fDeadline = objRun.fDeadline
+
+        def executeQuery(strEndpoint, strQuery):
+            # NOTE: A wrapper per query, as chunked queries run concurrently...
+            sparql = SPARQLWrapper(strEndpoint)
+            sparql.setReturnFormat(JSON)
             sparql.setQuery(strQuery)
-            return sparql.queryAndConvert()
+            if fDeadline is not None:
+                fRemaining = fDeadline - time.monotonic()
+                if fRemaining <= 0:
+                    raise TimeoutError('Deadline reached')
+                sparql.timeout = fRemaining # ...setTimeout() only takes whole seconds
+            dictSent = dictConditional.get(strQuery, None) if dictConditional else None
+            if dictSent:
+                if dictSent.get('etag', None):
+                    sparql.addCustomHttpHeader('If-None-Match', dictSent['etag'])
+                if dictSent.get('lastModified', None):
+                    sparql.addCustomHttpHeader('If-Modified-Since', dictSent['lastModified'])
+            try:
+                objQueryResult = sparql.query()
+            except urllib.error.HTTPError as e:
+                if e.code != 304 or not dictSent:
+                    raise
+                objRun.setNotModified.add(strQuery)
+                return { 'head': { 'vars': [] }, 'results': { 'bindings': [] } }
+            # NOTE: A result without headers (e.g. a stand-in for SPARQLWrapper) has no validators...
+            funcInfo = getattr(objQueryResult, 'info', None)
+            dictHeaders = funcInfo() if funcInfo is not None else {}
+            if dictHeaders.get('etag', None) or dictHeaders.get('last-modified', None):
+                objRun.dictValidators[strQuery] = { 'etag': dictHeaders.get('etag', None), 'lastModified': dictHeaders.get('last-modified', None) }
+            return objQueryResult.convert()
+
+        # All the requests go through the endpoint scheduler, unless disabled...
+        def scheduleQuery(strEndpoint, strQuery, iMaxRetries=None):
+            if scheduler is False:
+                return executeQuery(strEndpoint, strQuery)
+            schedulerEndpoint = scheduler or RequestScheduler.forEndpoint(
+                strEndpoint, fRate=self.dictOptions.get('rateLimit', None), iMaxConcurrency=self.dictOptions.get('maxConcurrency', 16)
+            )
+            return schedulerEndpoint.submit(executeQuery, strEndpoint, strQuery, fDeadline=fDeadline, iMaxRetries=iMaxRetries)
+
+        if isinstance(objEndpoint, str):
+            return lambda strQuery: scheduleQuery(objEndpoint, strQuery)
 
-        return executeQuery
+        # Replicas: balance the requests across them...
+        pool = self.dictOptions.get('endpointPool', None) or EndpointPool.forEndpoints(
+            objEndpoint, strBalancing=self.dictOptions.get('loadBalancing', None),
+            bHedge=self.dictOptions.get('hedge', None), fHedgeDelay=self.dictOptions.get('hedgeDelay', None)
+        )
+        # NOTE: The pool owns the retries, failing over to another replica at once rather than backing off on this one...
+        return lambda strQuery: pool.request(lambda strEndpoint, strPoolQuery: scheduleQuery(strEndpoint, strPoolQuery, 0), strQuery, fDeadline=fDeadline)
 
 
-    def __parsePrefixes(self, dictPrefixes: dict) -> list[str] :
+    def __parsePrefixes(self, dictPrefixes: dict | None) -> list[str] :
+        if dictPrefixes is None:
+            return []
         return list( map( lambda key: 'PREFIX %s: <%s>' % (key, dictPrefixes[key]), dictPrefixes.keys() ) )
 
 
     # Parser for VALUES Clause
-    def __parseValues(self, dictValues: dict, dictPrefixes: dict) -> list[str] :
+    def __parseValues(self, dictValues: dict, dictPrefixes: dict | None) -> list[str] :
+        """ Serialize the VALUES blocks.
+            A key with several variables ("?s ?o") takes a list of rows, serialized as
+            a multi-variable block, 'VALUES (?s ?o) { (...) (...) }'.
+        """
+        setPrefixes = frozenset(dictPrefixes) if dictPrefixes else frozenset()
+        funcSerialize = SPARQLTransformer.__serializeValue
         listParsedValues = []
-        for strValueKey in dictValues:
-            listValues = []
-            objValue = dictValues[strValueKey]
-            if objValue and type(objValue) is not list:
+        for strValueKey, objValue in dictValues.items():
+            listVarKeys = strValueKey.split()
+            if objValue is None or type(objValue) is not list:
                 objValue = [objValue]
-            for strValue in objValue:
-                # NOTE: Cursory Inspection of VALUES
-                #       We expect VALUES elements are well-formed just like WHERE elements,
-                #       but we'll do a little checking anyway...
-
-                # Resource: IRI...
-                if strValue.startswith('<') and strValue.endswith('>'):
-                    listValues.append(strValue)
-                # Resource: CIRIE...
-                elif isCIRIE(strValue, dictPrefixes):
-                    listValues.append(strValue)
-                # Literal: Value with Language...
-                elif re.match(r'^.+@[a-z]{2,3}(_[A-Z]{2})?$', strValue):
-                    strPart, strLang = strValue.split('@')
-                    if strPart.startswith('"') and strPart.endswith('"'):
-                        listValues.append(strValue)
-                    else:
-                        listValues.append('"%s"@%s' % (strPart, strLang))
-                # Literal: Value with Datetype...
-                elif re.match(r'^.+^^.+$', strValue):
-                    strPart, strType = strValue.split('^^')
-                    if not ( strPart.startswith('"') and strPart.endswith('"') ):
-                        strPart = '"%s"' % strPart
-                    if not ( ( strType.startswith('<') and strType.endswith('>') ) or isCIRIE(strType, dictPrefixes) ):
-                        strType = '<%s>' % strType
-                    listValues.append('%s^^%s' % (strPart, strType))
-                # Literal: anything else...
-                elif strValue.startswith('"') and strValue.endswith('"'):
-                    listValues.append(strValue)
-                elif strValue.find('\n') != -1 or strValue.find('"') != -1:
-                    listValues.append('"""%s"""' % strValue)
-                else:
-                    listValues.append('"%s"' % strValue)
+
+            # Multiple variables: one row per value...
+            if len(listVarKeys) > 1:
+                strVars = ' '.join( map(SPARQLTransformer.__makeSPARQLVariable, listVarKeys) )
+                listRows = [
+                    '(%s)' % ' '.join( [ funcSerialize(objItem, setPrefixes) for objItem in objRow ] )
+                    for objRow in objValue
+                ]
+                listParsedValues.append( 'VALUES (%s) {%s}' % ( strVars, ' '.join(listRows) ) )
+                continue
+
+            listValues = [ funcSerialize(objItem, setPrefixes) for objItem in objValue ]
             listParsedValues.append('VALUES %s {%s}' % (SPARQLTransformer.__makeSPARQLVariable(strValueKey), ' '.join(listValues)))
         return listParsedValues
 
+    @staticmethod
+    def __serializeValue(objValue, setPrefixes: frozenset) -> str:
+        """Classify and serialize a single VALUES term"""
+        # NOTE: Cursory Inspection of VALUES
+        #       We expect VALUES elements are well-formed just like WHERE elements,
+        #       but we'll do a little checking anyway...
+        if objValue is None:
+            return 'UNDEF'
+        if type(objValue) is bool:
+            return 'true' if objValue else 'false'
+        if type(objValue) in (int, float):
+            return str(objValue)
+
+        # Resource: IRI...
+        if objValue[:1] == '<' and objValue[-1:] == '>':
+            return objValue
+        # Resource: CIRIE...
+        matchValue = SPARQLTransformer._VALUES_CIRIE_REGEX.match(objValue)
+        if matchValue and matchValue.group(1) in setPrefixes:
+            return objValue
+        # Literal: Value with Language...
+        matchValue = SPARQLTransformer._VALUES_LANG_REGEX.match(objValue)
+        if matchValue:
+            return SPARQLTransformer.__quoteLiteral( matchValue.group(1) ) + '@' + matchValue.group(2)
+        # Literal: Value with Datatype...
+        matchValue = SPARQLTransformer._VALUES_DTYPE_REGEX.match(objValue)
+        if matchValue:
+            strType = matchValue.group(2)
+            if not ( strType[:1] == '<' and strType[-1:] == '>' ):
+                matchType = SPARQLTransformer._VALUES_CIRIE_REGEX.match(strType)
+                if not ( matchType and matchType.group(1) in setPrefixes ):
+                    strType = '<%s>' % strType
+            return SPARQLTransformer.__quoteLiteral( matchValue.group(1) ) + '^^' + strType
+        # Literal: anything else...
+        return SPARQLTransformer.__quoteLiteral(objValue)
+
+    @staticmethod
+    def __quoteLiteral(strValue: str) -> str:
+        """Quote a literal, escaping it in a single pass unless it is already quoted"""
+        if len(strValue) > 1 and strValue[0] == '"' and strValue[-1] == '"':
+            return strValue
+        return '"' + strValue.translate(SPARQLTransformer._LITERAL_ESCAPES) + '"'
+
 
-    def __processBindings(self, listResults: list | None):
+    def __processBindings(self, listBindings: list | None, fDeadline: float | None = None, dictBest: dict | None = None) -> list:
         # Create a list of processed results from:
         # 1. each result from the list of raw results
         # 2. a copy of the properties that fits the result
-        self.listResults = []
-        for self.objResult in listResults:
+        # Stop at the deadline, if any: the results are then fewer than the bindings.
+        # With a portable $bestlang, the best language ranks are those of these bindings, unless given.
+        if dictBest is None and self.dictOptions.get('bestlang', None):
+            dictBest = self.__bestLanguages(listBindings)
+        listResults = []
+        # Nested anchored objects shared by anchor value, if asked...
+        dictNodes = {} if ( self.dictOptions.get('shareNodes', False) or self.dictOptions.get('flatten', False) ) else None
+        for iResult, dictBinding in enumerate(listBindings):
             """Apply the property rules to a single result of the query results"""
+            if fDeadline is not None and iResult % 64 == 0 and time.monotonic() >= fDeadline:
+                break
             objWorkingResult = copy.deepcopy(self.dictProperties)
             for strWRKey in list(objWorkingResult):
-                self.__fitResult(strWRKey, objWorkingResult)
-            self.listResults.append(objWorkingResult)
+                self.__fitResult(strWRKey, objWorkingResult, dictBinding, dictNodes, '', dictBest)
+            listResults.append(objWorkingResult)
+        return listResults
 
 
-    def __fitResult(self, strWRKey: str, objWorkingResult: dict):
+    def __fitResult(self, strWRKey: str, objWorkingResult: dict, dictBinding: dict, dictNodes: dict | None = None, strPath: str = '',
+                    dictBest: dict | None = None):
         """Apply the SPARQL result to a single property of the properties"""
         objVariable = objWorkingResult[strWRKey]
 
         # If the variable is a dictionary...
         if isinstance(objVariable, dict):
             objAsList = objVariable.get('$asList', False)
-            for strSubWRKey in list(objVariable): # ...list() because we change the objVariable
-                self.__fitResult(strSubWRKey, objVariable)
-            # If any of the result entries do NOT contain a '@type' or '$anchor' key,
-            # throw away (pop off) the result...
-            bTypeAnchor = True
-            for strVarKey in objVariable:
-                if strVarKey not in ['@type', '$anchor']:
-                    bTypeAnchor = False
-            if bTypeAnchor:
-                objWorkingResult.pop(strWRKey)
+            strNodePath = strPath + '/' + strWRKey
+            # A shared anchored object: fitted once for the same values, otherwise merged in...
+            tupleNode = self.__nodeKey(strNodePath, objVariable, dictBinding) if ( dictNodes is not None and '$anchor' in objVariable ) else None
+            tupleShared = dictNodes.get(tupleNode[0], None) if tupleNode else None
+            if tupleShared and tupleNode[1] in tupleShared[1]:
+                objWorkingResult[strWRKey] = tupleShared[0]
+            else:
+                for strSubWRKey in list(objVariable): # ...list() because we change the objVariable
+                    self.__fitResult(strSubWRKey, objVariable, dictBinding, dictNodes, strNodePath, dictBest)
+                # If any of the result entries do NOT contain a '@type' or '$anchor' key,
+                # throw away (pop off) the result...
+                bTypeAnchor = True
+                for strVarKey in objVariable:
+                    if strVarKey not in ['@type', '$anchor']:
+                        bTypeAnchor = False
+                if bTypeAnchor:
+                    objWorkingResult.pop(strWRKey)
+                elif tupleShared:
+                    SPARQLTransformer.__mergeObject(tupleShared[0], objVariable)
+                    tupleShared[1].add(tupleNode[1])
+                    objWorkingResult[strWRKey] = tupleShared[0]
+                elif tupleNode:
+                    dictNodes[tupleNode[0]] = (objVariable, {tupleNode[1]})
             # If we need a list...
             if objAsList:
                 objWorkingResult[strWRKey] = [ objWorkingResult[strWRKey] ]
@@ -446,6 +1410,10 @@ WHERE {
         langTag = self.dictOptions['langTag']
         asList = "$asList" in objVariable
         objVariable = objVariable.replace("$asList", "")
+        bConcat = "$concat" in objVariable
+        objVariable = objVariable.replace("$concat", "")
+        bBestlang = "$bestlang" in objVariable
+        objVariable = objVariable.replace("$bestlang", "")
 
         if "$accept:" in objVariable:
             listLangParts = objVariable.split('$accept:')
@@ -457,7 +1425,12 @@ WHERE {
             langTag = listLangParts[1]
 
         # If the variable not in the raw result, delete it from the working result...
-        if objVariable not in self.objResult:
+        if objVariable not in dictBinding:
+            objWorkingResult.pop(strWRKey)
+        # A language worse than the best one for the object is dropped (portable $bestlang)...
+        elif bBestlang and dictBest is not None and (
+            self.__langRank(objVariable, dictBinding[objVariable]) < dictBest.get( self.__bestKey(objVariable, dictBinding), 0.0 )
+        ):
             objWorkingResult.pop(strWRKey)
         else:
             dictWorkingOpts = self.dictOptions.copy()
@@ -465,11 +1438,124 @@ WHERE {
             dictWorkingOpts['langTag'] = langTag
             dictWorkingOpts['list'] = asList
 
+            # A concatenated value holds all the values of the property: decode and transform each one...
+            if bConcat:
+                dictWorkingOpts['list'] = False
+                listValues = [
+                    SPARQLTransformer.__toJSONLDValue(dictValue, strWRKey, dictWorkingOpts)
+                    for dictValue in SPARQLTransformer.__decodeConcat(dictBinding[objVariable].get('value', ''))
+                ]
+                listValues = [objValue for objValue in listValues if objValue is not None]
+                if not listValues:
+                    objWorkingResult.pop(strWRKey)
+                else:
+                    objWorkingResult[strWRKey] = listValues if (asList or len(listValues) > 1) else listValues[0]
+                return
+
             # Transform the raw result value into our JSON-LD result value...
-            objWorkingResult[strWRKey] = SPARQLTransformer.__toJSONLDValue(self.objResult[objVariable], strWRKey, dictWorkingOpts)
+            objWorkingResult[strWRKey] = SPARQLTransformer.__toJSONLDValue(dictBinding[objVariable], strWRKey, dictWorkingOpts)
             if objWorkingResult[strWRKey] is None:
                 objWorkingResult.pop(strWRKey)
 
+    def __bestLanguages(self, listBindings: list) -> dict:
+        """Get the best language rank of each portable $bestlang property, by the object owning it"""
+        dictBest = {}
+        listVars = list( self.dictOptions['bestlang'] )
+        for dictBinding in listBindings:
+            for strVar in listVars:
+                dictValue = dictBinding.get(strVar, None)
+                if dictValue is None:
+                    continue
+                tupleKey = self.__bestKey(strVar, dictBinding)
+                fRank = self.__langRank(strVar, dictValue)
+                if fRank > dictBest.get(tupleKey, -1.0):
+                    dictBest[tupleKey] = fRank
+        return dictBest
+
+    def __bestLanguageRows(self, listBindings: list) -> list:
+        """Drop the rows with a language worse than the best one for its object (portable $bestlang), as the query filter would"""
+        dictBest = self.__bestLanguages(listBindings)
+        listVars = list( self.dictOptions['bestlang'] )
+        return [
+            dictBinding for dictBinding in listBindings
+            if not any(
+                strVar in dictBinding and self.__langRank(strVar, dictBinding[strVar]) < dictBest.get( self.__bestKey(strVar, dictBinding), 0.0 )
+                for strVar in listVars
+            )
+        ]
+
+    def __bestKey(self, strVar: str, dictBinding: dict) -> tuple:
+        """The key of a $bestlang property: its variable and the anchor value of the object owning it"""
+        strOwner = self.dictOptions['bestlang'][strVar]['owner']
+        dictOwner = dictBinding.get(strOwner, None) if strOwner else None
+        return ( strVar, dictOwner.get('value', None) if dictOwner else None )
+
+    def __langRank(self, strVar: str, dictValue: dict) -> float:
+        """ Rank a value by the language priorities of its property (e.g. "en;q=1, fr;q=0.5"), as BEST_LANGMATCH:
+            a literal without language counts as English, an exact match is preferred to a range one.
+        """
+        listPriorities = self.dictLangPriorities.get(strVar, None)
+        if listPriorities is None:
+            listPriorities = self.dictLangPriorities[strVar] = [
+                ( strLang.lower(), float(strQ) if strQ else 1.0 )
+                for strLang, strQ in SPARQLTransformer._LANG_PRIORITY_REGEX.findall( self.dictOptions['bestlang'][strVar]['lang'] )
+            ]
+        if dictValue.get('type', None) != 'literal':
+            return 0.0
+        strLang = ( dictValue.get('xml:lang', None) or 'en' ).lower()
+        fRank = 0.0
+        for strPriorityLang, fQ in listPriorities:
+            if strPriorityLang == strLang:
+                fRank = max(fRank, fQ + 0.001)
+            elif strPriorityLang == '*' or strLang.startswith(strPriorityLang + '-'):
+                fRank = max(fRank, fQ)
+        return fRank
+
+    def __nodeKey(self, strNodePath: str, dictNode: dict, dictBinding: dict) -> tuple | None:
+        """ Get the key of a nested anchored object, by path and anchor value, and the values it is fitted from.
+            Return None if its anchor is not a bound variable.
+        """
+        listVars = self.dictNodeVars.get(strNodePath, None)
+        if listVars is None:
+            objAnchor = dictNode.get(dictNode['$anchor'], None)
+            listVars = []
+            if isinstance(objAnchor, str) and objAnchor.startswith('?'):
+                strAnchorVar = objAnchor[1:].split('$')[0]
+                listVars = [strAnchorVar] + [ strVar for strVar in SPARQLTransformer.__collectVariables(dictNode) if strVar != strAnchorVar ]
+            self.dictNodeVars[strNodePath] = listVars
+        if not listVars or listVars[0] not in dictBinding:
+            return None
+        tupleValues = tuple( _packBindingValue( dictBinding.get(strVar, None) ) for strVar in listVars )
+        return (strNodePath, tupleValues[0]), tupleValues
+
+    @staticmethod
+    def __encodeConcat(strID: str) -> str:
+        """ Encode the values of a variable for GROUP_CONCAT, keeping their kind, language and datatype:
+            IRIs as '<' + IRI, literals as '"' + value + FS + language + FS + datatype
+        """
+        return (
+            'IF(isIRI(%s), CONCAT("<", STR(%s)), '
+            'IF(isLiteral(%s), CONCAT("\\"", STR(%s), "%s", LANG(%s), "%s", STR(DATATYPE(%s))), ""))'
+        ) % (strID, strID, strID, strID, _CONCAT_FIELD_SPARQL, strID, _CONCAT_FIELD_SPARQL, strID)
+
+    @staticmethod
+    def __decodeConcat(strConcat: str) -> list[dict]:
+        """Decode a GROUP_CONCAT value into a list of SPARQL JSON result values"""
+        listDecoded = []
+        for strItem in strConcat.split(_CONCAT_SEPARATOR):
+            if strItem[:1] == '<':
+                listDecoded.append( { 'type': 'uri', 'value': strItem[1:] } )
+            elif strItem[:1] == '"':
+                strValue, strLang, strType = strItem[1:].rsplit(_CONCAT_FIELD, 2)
+                dictDecoded = { 'type': 'literal', 'value': strValue }
+                if strLang:
+                    dictDecoded['xml:lang'] = strLang
+                elif strType and strType not in XSD.XSD_STRING_TYPES:
+                    dictDecoded['datatype'] = strType
+                listDecoded.append(dictDecoded)
+            # Otherwise, an empty concatenation or a blank node...
+        return listDecoded
+
     @staticmethod
     def __toJSONLDValue(dictResultValue: dict, strWRKey: str, dictWorkingOpts: dict):
         """ Prepare the output managing languages and datatypes.
@@ -574,37 +1660,45 @@ WHERE {
                 base[k] = a
                 continue
 
-            b = base[k]
-
             anchor = None
             if isinstance(a, dict) and '$anchor' in a:
                 anchor = a['$anchor']
 
-            # If a is an array, take its first value...
-            if isinstance(a, list):
-                a = a[0]
+            # If a is an array, merge each of its values...
+            for a in (a if isinstance(a, list) else [a]):
+                b = base[k]
+
+                if a is b:  # ...a shared object
+                    continue
 
-            if isinstance(b, list):
-                if anchor:
-                    same_ids = [x for x in b if anchor in x and a[anchor] == x[anchor]]
-                    if len(same_ids) > 0:
-                        SPARQLTransformer.__mergeObject(same_ids[0], a)
+                if isinstance(b, list):
+                    if any(x is a for x in b):
                         continue
+                    if anchor:
+                        same_ids = [x for x in b if anchor in x and a[anchor] == x[anchor]]
+                        if len(same_ids) > 0:
+                            SPARQLTransformer.__mergeObject(same_ids[0], a)
+                            continue
 
-                if not any([SPARQLTransformer.__deepEquals(x, a) for x in b]):
-                    b.append(a)
-                continue
+                    if not any([SPARQLTransformer.__deepEquals(x, a) for x in b]):
+                        b.append(a)
+                    continue
 
-            if SPARQLTransformer.__deepEquals(a, b):
-                continue
+                if SPARQLTransformer.__deepEquals(a, b):
+                    continue
 
-            if anchor and anchor in b and a[anchor] == b[anchor]:  # same ids
-                SPARQLTransformer.__mergeObject(b, a)
-            else:
-                base[k] = [b, a]
+                if anchor and anchor in b and a[anchor] == b[anchor]:  # same ids
+                    SPARQLTransformer.__mergeObject(b, a)
+                else:
+                    base[k] = [b, a]
 
         return base
 
+    @staticmethod
+    def __anchorHashKey(objAnchor):
+        """A hashable key for an anchor value"""
+        return objAnchor if isinstance(objAnchor, str) else dumps(objAnchor, sort_keys=True)
+
     @staticmethod
     def __makeSPARQLVariable(strVar : str) -> str :
         """Add the "?" if absent"""
@@ -612,10 +1706,18 @@ WHERE {
 
     @staticmethod
     def __processProperties(
-        dictProperty: dict, listVars: list = [], dictValues: dict = {}, listWheres: list = [], listFilters: list = [],
-        strLangPrimary: str = None, strPrefix: str = "v", strIDPriorRoot: str = None
+        dictProperty: dict, listVars: list | None = None, dictValues: dict | None = None, listWheres: list | None = None,
+        listFilters: list | None = None, strLangPrimary: str = None, strPrefix: str = "v", strIDPriorRoot: str = None,
+        dictBestlangs: dict | None = None
     ):
-        """Parse a single key in prototype"""
+        """ Parse a single key in prototype.
+            With dictBestlangs, $bestlang is portable: the properties are queried with all their languages,
+            and dictBestlangs gets their language priorities and the variable of the object owning them.
+        """
+        listVars = [] if listVars is None else listVars
+        dictValues = {} if dictValues is None else dictValues
+        listWheres = [] if listWheres is None else listWheres
+        listFilters = [] if listFilters is None else listFilters
         strIDRoot, isBlockRequired = SPARQLTransformer.__computeRootID(dictProperty, strPrefix)
         strIDRoot = strIDRoot or strIDPriorRoot or '?id'
 
@@ -631,7 +1733,7 @@ WHERE {
                 listWheresInner = []
                 funcWhere, isBlockRequiredInner = SPARQLTransformer.__processProperties(
                         objSubProperty, listVars, dictValues, listWheresInner, listFilters,
-                        strLangPrimary, strPrefix + str(indexMaster) if indexMaster else "", strIDRoot
+                        strLangPrimary, strPrefix + str(indexMaster) if indexMaster else "", strIDRoot, dictBestlangs
                     )
 
                 for indexSub, keySub in enumerate(list(objSubProperty)):
@@ -680,7 +1782,7 @@ WHERE {
             isRequired = (
                 'required' in listSubPropertyOptions or
                 keyMaster in ['id', '@id'] or
-                strID in dictValues or
+                any( strID in strValueKey.split() for strValueKey in dictValues ) or
                 ( len(listAggregate) > 0 and isKeyed )
             )
 
@@ -694,13 +1796,17 @@ WHERE {
                 strDistinct = 'DISTINCT ' if 'distinct' in listSubPropertyOptions else ''
                 strVar = f"({listAggregate[0].upper()}({strDistinct}{idAggregate}) AS {strID})"
 
-            if len(listBestlang) > 0:
+            if len(listBestlang) > 0 and 'concat' not in listSubPropertyOptions:
                 strBestlang = listBestlang[0]
                 dictProperty[keyMaster] = strID + '$accept:string'
                 strBestLang = strBestlang.split(':')[1] if ':' in strBestlang else strLangPrimary
                 if strBestLang is None:
                     raise AttributeError('bestlang require a language declared inline or in the root')
-                strVar = '(sql:BEST_LANGMATCH(%s, "%s", "en") AS %s)' % (strID, strBestLang, strID)
+                if dictBestlangs is not None:
+                    dictProperty[keyMaster] += '$bestlang'
+                    dictBestlangs[ strID[1:] ] = { 'lang': strBestLang, 'owner': strIDRoot[1:] if strID != strIDRoot else None }
+                else:
+                    strVar = '(sql:BEST_LANGMATCH(%s, "%s", "en") AS %s)' % (strID, strBestLang, strID)
             elif len(listAccept) > 0:
                 dictProperty[keyMaster] = strID + '$' + listAccept[0]
 
@@ -710,6 +1816,14 @@ WHERE {
             if 'list' in listSubPropertyOptions and strID != strIDRoot:
                 dictProperty[keyMaster] += '$asList'
 
+            # Concatenate all the values of the property in a single row...
+            if 'concat' in listSubPropertyOptions and isKeyed and strID != strIDRoot and len(listAggregate) == 0:
+                strConcatID = strID + '_concat'
+                dictProperty[keyMaster] = strConcatID + dictProperty[keyMaster][len(strID):] + '$concat'
+                strVar = '(GROUP_CONCAT(DISTINCT %s; SEPARATOR="%s") AS %s)' % (
+                    SPARQLTransformer.__encodeConcat(strID), _CONCAT_SEPARATOR_SPARQL, strConcatID
+                )
+
             if strVar not in listVars:
                 listVars.append(strVar)
 
@@ -840,6 +1954,620 @@ WHERE {
     def __deepEquals(a, b):
         return a == b or dumps(a) == dumps(b)
 
+class RequestScheduler:
+    """ Schedule the requests to an endpoint, adapting to its limits:
+        - a token bucket caps the request rate (fRate requests per second, up to iBurst at once),
+        - an AIMD window caps the concurrent requests: it grows by one request per window of
+          successful requests, halves on throttling (HTTP 429/503) or errors, and shrinks when
+          the latency grows beyond fLatencyTolerance times the best observed latency,
+        - throttled and failed requests are retried up to iMaxRetries times, waiting for the
+          'Retry-After' header or a jittered exponential backoff.
+        Schedulers are shared per endpoint and configuration (see forEndpoint()).
+    """
+
+    _RETRY_CODES = [429, 502, 503, 504]
+
+    _dictSchedulers = {}
+    _lockSchedulers = threading.Lock()
+
+    def __init__(self, fRate: float | None = None, iBurst: int | None = None,
+                 iMaxConcurrency: int = 16, iMinConcurrency: int = 1, iInitialConcurrency: int = 4,
+                 iMaxRetries: int = 5, fBackoff: float = 0.5, fMaxBackoff: float = 30.0, fLatencyTolerance: float = 2.0):
+        self.fRate = fRate
+        self.fBurst = float( iBurst or max(1, int(fRate or 1)) )
+        self.fTokens = self.fBurst
+        self.fRefillTime = time.monotonic()
+
+        self.iMaxConcurrency = iMaxConcurrency
+        self.iMinConcurrency = iMinConcurrency
+        self.fConcurrency = float( min(max(iInitialConcurrency, iMinConcurrency), iMaxConcurrency) )
+        self.iOutstanding = 0
+
+        self.iMaxRetries = iMaxRetries
+        self.fBackoff = fBackoff
+        self.fMaxBackoff = fMaxBackoff
+        self.fLatencyTolerance = fLatencyTolerance
+        self.fMinLatency = None
+        self.fBlockedUntil = 0.0
+
+        self.condition = threading.Condition()
+
+    @classmethod
+    def forEndpoint(cls, strEndpoint: str, **kwargs):
+        """Get the scheduler shared by all the requests to an endpoint with the same kwargs, creating it when missing"""
+        dictArgs = { strKey: objArg for strKey, objArg in kwargs.items() if objArg is not None }
+        tupleKey = ( strEndpoint, tuple( sorted( dictArgs.items() ) ) )
+        with cls._lockSchedulers:
+            scheduler = cls._dictSchedulers.get(tupleKey, None)
+            if scheduler is None:
+                scheduler = cls(**dictArgs)
+                cls._dictSchedulers[tupleKey] = scheduler
+            return scheduler
+
+    def submit(self, funcRequest: Callable, *args, fDeadline: float | None = None, iMaxRetries: int | None = None):
+        """ Run a request once the rate and concurrency limits allow it, retrying it when throttled
+            (up to iMaxRetries times, by default the scheduler's own).
+            Give up with a TimeoutError when the deadline (a time.monotonic() value) would be passed.
+        """
+        if iMaxRetries is None:
+            iMaxRetries = self.iMaxRetries
+        iAttempt = 0
+        while True:
+            self.__acquire(fDeadline)
+            fStart = time.monotonic()
+            try:
+                objResult = funcRequest(*args)
+            except Exception as e:
+                bRetry, fRetryAfter = RequestScheduler.retryInfo(e)
+                # NOTE: Only the endpoint failures shrink the window, not the bad requests...
+                self.__release(time.monotonic() - fStart, bFailed=bRetry)
+                if not bRetry or iAttempt >= iMaxRetries:
+                    raise
+                fDelay = self.__backoff(iAttempt, fRetryAfter)
+                if fDeadline is not None and time.monotonic() + fDelay >= fDeadline:
+                    raise
+                logger.warning('WARNING: Request failed (%s), retrying in %.2fs' % (e, fDelay))
+                time.sleep(fDelay)
+                iAttempt += 1
+                continue
+            self.__release(time.monotonic() - fStart, bFailed=False)
+            return objResult
+
+    def __acquire(self, fDeadline: float | None = None):
+        with self.condition:
+            while True:
+                fNow = time.monotonic()
+                if fDeadline is not None and fNow >= fDeadline:
+                    raise TimeoutError('Deadline reached while waiting for the endpoint scheduler')
+                self.__refill(fNow)
+                fWait = None
+                if fNow < self.fBlockedUntil:
+                    fWait = self.fBlockedUntil - fNow
+                elif self.iOutstanding >= int(self.fConcurrency):
+                    fWait = None # ...until a request ends
+                elif self.fRate and self.fTokens < 1.0:
+                    fWait = (1.0 - self.fTokens) / self.fRate
+                else:
+                    if self.fRate:
+                        self.fTokens -= 1.0
+                    self.iOutstanding += 1
+                    return
+                if fDeadline is not None:
+                    fWait = min(fWait, fDeadline - fNow) if fWait is not None else fDeadline - fNow
+                self.condition.wait(fWait)
+
+    def __refill(self, fNow: float):
+        if self.fRate:
+            self.fTokens = min( self.fBurst, self.fTokens + (fNow - self.fRefillTime) * self.fRate )
+        self.fRefillTime = fNow
+
+    def __release(self, fLatency: float, bFailed: bool):
+        with self.condition:
+            self.iOutstanding -= 1
+            if bFailed:
+                # Multiplicative decrease...
+                self.fConcurrency = max( self.iMinConcurrency, self.fConcurrency / 2.0 )
+            else:
+                if self.fMinLatency is None or fLatency < self.fMinLatency:
+                    self.fMinLatency = fLatency
+                if fLatency > self.fMinLatency * self.fLatencyTolerance and self.fConcurrency > self.iMinConcurrency:
+                    # ...the endpoint is queueing our requests: back off gently...
+                    self.fConcurrency = max( self.iMinConcurrency, self.fConcurrency * 0.9 )
+                else:
+                    # Additive increase: one more request per window...
+                    self.fConcurrency = min( self.iMaxConcurrency, self.fConcurrency + 1.0 / self.fConcurrency )
+            self.condition.notify_all()
+
+    def __backoff(self, iAttempt: int, fRetryAfter: float | None) -> float:
+        fDelay = random.uniform( 0, min(self.fMaxBackoff, self.fBackoff * (2 ** iAttempt)) )
+        if fRetryAfter is not None:
+            # The endpoint told us when: hold every request to it until then...
+            fDelay = fRetryAfter + fDelay * 0.1
+            with self.condition:
+                self.fBlockedUntil = max( self.fBlockedUntil, time.monotonic() + fRetryAfter )
+        return fDelay
+
+    @staticmethod
+    def retryInfo(e: Exception) -> tuple[bool, float | None]:
+        """Whether a failed request should be retried, and after how long the endpoint asks for it"""
+        import urllib.error
+        if isinstance(e, urllib.error.HTTPError):
+            if e.code not in RequestScheduler._RETRY_CODES:
+                return (False, None)
+            return ( True, RequestScheduler.__parseRetryAfter( e.headers.get('Retry-After', None) if e.headers else None ) )
+        return ( isinstance(e, (urllib.error.URLError, ConnectionError, TimeoutError)), None )
+
+    @staticmethod
+    def __parseRetryAfter(strRetryAfter: str | None) -> float | None:
+        if not strRetryAfter:
+            return None
+        try:
+            return max( 0.0, float(strRetryAfter) )
+        except ValueError:
+            pass
+        try:
+            import email.utils
+            return max( 0.0, email.utils.parsedate_to_datetime(strRetryAfter).timestamp() - time.time() )
+        except (TypeError, ValueError):
+            return None
+
+class EndpointPool:
+    """ Balance the requests across replica endpoints of the same store:
+        - 'roundrobin' or 'leastOutstanding' (fewest requests in flight) balancing over the healthy replicas,
+        - a replica failing iMaxFailures times in a row is left out for fCooldown seconds,
+          and a failed request is sent again to another replica; when all of them failed, the request is
+          retried up to iMaxRetries times, waiting for the 'Retry-After' header or a jittered exponential backoff,
+        - hedged requests (bHedge): when a request takes longer than fHedgeDelay (by default the observed
+          95th percentile latency), a copy is sent to another replica and the first answer wins.
+        Pools are shared per list of replicas and configuration (see forEndpoints()).
+    """
+
+    _dictPools = {}
+    _lockPools = threading.Lock()
+
+    _MIN_LATENCY_SAMPLES = 20
+    _DEFAULT_HEDGE_DELAY = 1.0
+
+    def __init__(self, listEndpoints: list, strBalancing: str = 'roundrobin', bHedge: bool = False,
+                 fHedgeDelay: float | None = None, iMaxFailures: int = 3, fCooldown: float = 30.0,
+                 iMaxRetries: int = 2, fBackoff: float = 0.5, fMaxBackoff: float = 30.0):
+        if not listEndpoints:
+            raise ValueError('EndpointPool requires at least one endpoint')
+        if strBalancing not in ('roundrobin', 'leastOutstanding'):
+            raise ValueError('Unknown load balancing [%s]' % strBalancing)
+        self.listEndpoints = list(listEndpoints)
+        self.strBalancing = strBalancing
+        self.bHedge = bHedge
+        self.fHedgeDelay = fHedgeDelay
+        self.iMaxFailures = iMaxFailures
+        self.fCooldown = fCooldown
+        self.iMaxRetries = iMaxRetries
+        self.fBackoff = fBackoff
+        self.fMaxBackoff = fMaxBackoff
+
+        self.iNext = 0
+        self.dictOutstanding = { strEndpoint: 0 for strEndpoint in self.listEndpoints }
+        self.dictFailures = { strEndpoint: 0 for strEndpoint in self.listEndpoints }
+        self.dictDownUntil = { strEndpoint: 0.0 for strEndpoint in self.listEndpoints }
+        self.listLatencies = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def forEndpoints(cls, listEndpoints: list, **kwargs):
+        """Get the pool shared by all the requests to a list of replicas with the same kwargs, creating it when missing"""
+        dictArgs = { strKey: objArg for strKey, objArg in kwargs.items() if objArg is not None }
+        tupleKey = ( tuple(listEndpoints), tuple( sorted( dictArgs.items() ) ) )
+        with cls._lockPools:
+            pool = cls._dictPools.get(tupleKey, None)
+            if pool is None:
+                pool = cls(listEndpoints, **dictArgs)
+                cls._dictPools[tupleKey] = pool
+            return pool
+
+    def choose(self, setExclude: set = frozenset()) -> str | None:
+        """Choose the replica for the next request"""
+        with self.lock:
+            fNow = time.monotonic()
+            listCandidates = [strEndpoint for strEndpoint in self.listEndpoints if strEndpoint not in setExclude]
+            listHealthy = [strEndpoint for strEndpoint in listCandidates if self.dictDownUntil[strEndpoint] <= fNow]
+            listCandidates = listHealthy or listCandidates # ...all down: try them anyway
+            if not listCandidates:
+                return None
+            self.iNext += 1
+            if self.strBalancing == 'leastOutstanding':
+                iOffset = self.iNext % len(listCandidates) # ...rotate the ties
+                listRotated = listCandidates[iOffset:] + listCandidates[:iOffset]
+                return min(listRotated, key=lambda strEndpoint: self.dictOutstanding[strEndpoint])
+            return listCandidates[self.iNext % len(listCandidates)]
+
+    def hedgeDelay(self) -> float:
+        if self.fHedgeDelay is not None:
+            return self.fHedgeDelay
+        with self.lock:
+            if len(self.listLatencies) < EndpointPool._MIN_LATENCY_SAMPLES:
+                return EndpointPool._DEFAULT_HEDGE_DELAY
+            listSorted = sorted(self.listLatencies)
+        return listSorted[ int( 0.95 * (len(listSorted) - 1) ) ]
+
+    def request(self, funcRequest: Callable, strQuery: str, fDeadline: float | None = None):
+        """Run funcRequest(endpoint, query) on the replicas"""
+        setTried = set()
+        iAttempt = 0
+        while True:
+            strEndpoint = self.choose(setTried)
+            setTried.add(strEndpoint)
+            try:
+                if self.bHedge and len(setTried) < len(self.listEndpoints):
+                    return self.__hedgedCall(funcRequest, strQuery, strEndpoint, setTried, fDeadline)
+                return self.__call(funcRequest, strEndpoint, strQuery)
+            except Exception as e:
+                bRetry, fRetryAfter = RequestScheduler.retryInfo(e)
+                bExpired = fDeadline is not None and time.monotonic() >= fDeadline
+                if not bRetry or bExpired:
+                    raise
+                if len(setTried) < len(self.listEndpoints):
+                    logger.warning('WARNING: Replica %s failed (%s), trying another one' % (strEndpoint, e))
+                    continue
+                # Every replica failed: wait, then go over them again...
+                if iAttempt >= self.iMaxRetries:
+                    raise
+                fDelay = random.uniform( 0, min(self.fMaxBackoff, self.fBackoff * (2 ** iAttempt)) )
+                if fRetryAfter is not None:
+                    fDelay = fRetryAfter + fDelay * 0.1
+                if fDeadline is not None and time.monotonic() + fDelay >= fDeadline:
+                    raise
+                logger.warning('WARNING: All the replicas failed (%s), retrying in %.2fs' % (e, fDelay))
+                time.sleep(fDelay)
+                iAttempt += 1
+                setTried.clear()
+
+    def __hedgedCall(self, funcRequest: Callable, strQuery: str, strEndpoint: str, setTried: set, fDeadline: float | None):
+        import queue
+        queueAnswers = queue.Queue()
+
+        def run(strRunEndpoint):
+            try:
+                queueAnswers.put( (True, self.__call(funcRequest, strRunEndpoint, strQuery)) )
+            except Exception as e:
+                queueAnswers.put( (False, e) )
+
+        threading.Thread(target=run, args=(strEndpoint,), daemon=True).start()
+        iRunning = 1
+        fHedgeDelay = self.hedgeDelay()
+        if fDeadline is not None:
+            fHedgeDelay = max( 0.0, min(fHedgeDelay, fDeadline - time.monotonic()) )
+        try:
+            bOK, objAnswer = queueAnswers.get(timeout=fHedgeDelay)
+            if bOK:
+                return objAnswer
+            bRetry, _fRetryAfter = RequestScheduler.retryInfo(objAnswer)
+            if not bRetry:
+                raise objAnswer
+            iRunning -= 1
+            excLast = objAnswer
+        except queue.Empty:
+            excLast = None
+
+        # Slow or failed: hedge on another replica...
+        strHedgeEndpoint = self.choose(setTried)
+        if strHedgeEndpoint is not None:
+            setTried.add(strHedgeEndpoint)
+            threading.Thread(target=run, args=(strHedgeEndpoint,), daemon=True).start()
+            iRunning += 1
+        while iRunning > 0:
+            fTimeout = max(0.0, fDeadline - time.monotonic()) if fDeadline is not None else None
+            try:
+                bOK, objAnswer = queueAnswers.get(timeout=fTimeout)
+            except queue.Empty:
+                raise TimeoutError('Deadline reached while waiting for the replicas')
+            if bOK:
+                return objAnswer
+            iRunning -= 1
+            excLast = objAnswer
+        raise excLast
+
+    def __call(self, funcRequest: Callable, strEndpoint: str, strQuery: str):
+        with self.lock:
+            self.dictOutstanding[strEndpoint] += 1
+        fStart = time.monotonic()
+        try:
+            objResult = funcRequest(strEndpoint, strQuery)
+        except Exception as e:
+            # NOTE: A bad request (e.g. HTTP 400) fails on every replica, it is not the replica failing...
+            bRetry, _fRetryAfter = RequestScheduler.retryInfo(e)
+            with self.lock:
+                self.dictOutstanding[strEndpoint] -= 1
+                if bRetry:
+                    self.dictFailures[strEndpoint] += 1
+                    if self.dictFailures[strEndpoint] >= self.iMaxFailures:
+                        self.dictDownUntil[strEndpoint] = time.monotonic() + self.fCooldown
+            raise
+        with self.lock:
+            self.dictOutstanding[strEndpoint] -= 1
+            self.dictFailures[strEndpoint] = 0
+            self.dictDownUntil[strEndpoint] = 0.0
+            self.listLatencies.append( time.monotonic() - fStart )
+            if len(self.listLatencies) > 200:
+                del self.listLatencies[:100]
+        return objResult
+
+class ResultCache:
+    """ A least recently used cache of transformed results, shared by transformers through the 'cache' option.
+        Entries are fresh for fTTL seconds, if given, and at most iMaxSize of them are kept.
+        Expired entries whose answers had an ETag or Last-Modified are revalidated with conditional requests.
+    """
+
+    def __init__(self, iMaxSize: int = 256, fTTL: float | None = None):
+        import collections
+        self.iMaxSize = iMaxSize
+        self.fTTL = fTTL
+        self.dictEntries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.iHits = 0
+        self.iMisses = 0
+        self.iRevalidations = 0
+
+    def get(self, objKey) -> dict | None:
+        """Get a fresh entry"""
+        dictEntry, bFresh = self.lookup(objKey)
+        return dictEntry if bFresh else None
+
+    def lookup(self, objKey) -> tuple[dict | None, bool]:
+        """ Get an entry and whether it is fresh.
+            Expired entries with validators (ETag / Last-Modified) are kept, to be revalidated.
+        """
+        with self.lock:
+            dictEntry = self.dictEntries.get(objKey, None)
+            bFresh = dictEntry is not None and ( self.fTTL is None or time.monotonic() - dictEntry['time'] <= self.fTTL )
+            if dictEntry is not None and not bFresh and not dictEntry.get('validators', None):
+                del self.dictEntries[objKey]
+                dictEntry = None
+            if dictEntry is None:
+                self.iMisses += 1
+                return (None, False)
+            self.dictEntries.move_to_end(objKey)
+            if bFresh:
+                self.iHits += 1
+            else:
+                self.iRevalidations += 1
+            return (dictEntry, bFresh)
+
+    def touch(self, objKey):
+        """Make an entry fresh again, once revalidated"""
+        with self.lock:
+            dictEntry = self.dictEntries.get(objKey, None)
+            if dictEntry is not None:
+                dictEntry['time'] = time.monotonic()
+
+    def put(self, objKey, dictEntry: dict):
+        dictEntry['time'] = time.monotonic()
+        with self.lock:
+            self.dictEntries[objKey] = dictEntry
+            self.dictEntries.move_to_end(objKey)
+            while len(self.dictEntries) > self.iMaxSize:
+                self.dictEntries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.dictEntries.clear()
+
+    def __len__(self):
+        return len(self.dictEntries)
+
+def __getattr__(strName: str):
+    # Keep SPARQLWrapper reachable as a module attribute, while importing it on first use...
+    if strName in ('SPARQLWrapper', 'JSON'):
+        import SPARQLWrapper as moduleSPARQLWrapper
+        return getattr(moduleSPARQLWrapper, strName)
+    raise AttributeError('module %r has no attribute %r' % (__name__, strName))
+
+def buildBundle(strDirectory: str, strBundlePath: str, dictOptions: dict | None = None) -> int:
+    """ Precompile all the JSON queries of a directory into a single bundle file.
+        The plans are keyed by file name without extension. Return the number of plans.
+    """
+    dictPlans = {}
+    for strFileName in sorted( os.listdir(strDirectory) ):
+        if not strFileName.endswith('.json'):
+            continue
+        strName = strFileName[:-len('.json')]
+        dictPlans[strName] = SPARQLTransformer( os.path.join(strDirectory, strFileName), dictOptions ).plan()
+
+    with open(strBundlePath, 'w') as fileBundle:
+        json.dump( { 'version': BUNDLE_VERSION, 'plans': dictPlans }, fileBundle, separators=(',', ':') )
+    return len(dictPlans)
+
+def loadBundle(strBundlePath: str) -> dict:
+    """Load the plans of a bundle in a single read, to be used with SPARQLTransformer.fromPlan()"""
+    with open(strBundlePath, 'rb') as fileBundle:
+        dictBundle = json.loads( fileBundle.read() )
+    if dictBundle.get('version', None) != BUNDLE_VERSION:
+        raise ValueError( 'Bundle version %s not supported (expected %s), rebuild it' % (dictBundle.get('version', None), BUNDLE_VERSION) )
+    return dictBundle['plans']
+
+def main(listArgs: list | None = None) -> int:
+    import argparse
+    parser = argparse.ArgumentParser(prog='sparql-transformer', description='SPARQL Transformer tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parserBundle = subparsers.add_parser('bundle', help='precompile a directory of JSON queries into a bundle')
+    parserBundle.add_argument('directory', help='directory of JSON queries')
+    parserBundle.add_argument('-o', '--output', default='queries.bundle.json', help='bundle file (default: %(default)s)')
+    parserBundle.add_argument('--values-chunk-size', type=int, default=None, help='split the $values in chunks of this size')
+
+    parserRun = subparsers.add_parser('run', help='transform JSON queries, writing each result as a line of JSON (NDJSON)',
+                                      description='Transform the JSON queries of the given files and directories or, with no path, '
+                                                  'the query given by --query once per row of parameters read from stdin as NDJSON, '
+                                                  'each row bound as its $values. Timings are written to stderr.')
+    parserRun.add_argument('paths', nargs='*', help='JSON query files or directories of them')
+    parserRun.add_argument('-q', '--query', default=None, help='JSON query file to bind the stdin rows into')
+    parserRun.add_argument('-w', '--workers', type=int, default=4, help='concurrent transforms (default: %(default)s)')
+    parserRun.add_argument('-e', '--endpoint', default=None, help='SPARQL endpoint (default: DBpedia)')
+    parserRun.add_argument('--cache', type=int, default=256, help='results kept in the cache, 0 to disable (default: %(default)s)')
+    parserRun.add_argument('--timeout', type=float, default=None, help='time budget in seconds of each transform')
+
+    args = parser.parse_args(listArgs)
+    if args.command == 'bundle':
+        dictOptions = { 'valuesChunkSize': args.values_chunk_size } if args.values_chunk_size else None
+        iPlans = buildBundle(args.directory, args.output, dictOptions)
+        print('%d plans written to %s' % (iPlans, args.output))
+    elif args.command == 'run':
+        return _runQueries(args)
+    return 0
+
+def _runQueries(args) -> int:
+    """The 'run' command: transform the queries concurrently, streaming the results in order as NDJSON"""
+    import sys
+    import collections
+    import concurrent.futures
+
+    if not args.paths and args.query is None:
+        sys.stderr.write('run: give query paths, or a --query to bind the stdin rows into\n')
+        return 2
+    dictOptions = {}
+    if args.endpoint:
+        dictOptions['endpoint'] = args.endpoint
+    if args.cache > 0:
+        dictOptions['cache'] = ResultCache(args.cache)
+    if args.timeout is not None:
+        dictOptions['timeout'] = args.timeout
+
+    # The jobs: a name and a query (a path or a dict)...
+    def listJobs():
+        for strPath in args.paths:
+            if os.path.isdir(strPath):
+                for strFileName in sorted( os.listdir(strPath) ):
+                    if strFileName.endswith('.json'):
+                        yield ( os.path.join(strPath, strFileName), os.path.join(strPath, strFileName) )
+            else:
+                yield (strPath, strPath)
+        if not args.paths:
+            with open(args.query) as fileQuery:
+                dictQuery = json.load(fileQuery)
+            for iLine, strLine in enumerate(sys.stdin):
+                if not strLine.strip():
+                    continue
+                dictQueryRow = dict(dictQuery)
+                dictQueryRow['$values'] = { **dictQuery.get('$values', {}), **json.loads(strLine) }
+                yield ( '%s:%d' % (args.query, iLine + 1), dictQueryRow )
+
+    def transformJob(tupleJob):
+        fStart = time.perf_counter()
+        try:
+            objRun = SPARQLTransformer(tupleJob[1], dictOptions).run()
+        except Exception as e:
+            return (tupleJob[0], None, e, time.perf_counter() - fStart)
+        return (tupleJob[0], objRun, None, time.perf_counter() - fStart)
+
+    iJobs = 0
+    iErrors = 0
+    def writeJob(tupleDone):
+        nonlocal iJobs, iErrors
+        strName, objRun, e, fSeconds = tupleDone
+        iJobs += 1
+        if e is not None:
+            iErrors += 1
+            sys.stderr.write( '%s\terror %.3fs\t%s: %s\n' % (strName, fSeconds, type(e).__name__, e) )
+            return
+        sys.stdout.write( dumps(objRun.objResults, ensure_ascii=False) + '\n' )
+        sys.stdout.flush()
+        strState = 'cached' if objRun.bCached else ( 'truncated' if objRun.bTruncated else 'ok' )
+        sys.stderr.write( '%s\t%s %.3fs\n' % (strName, strState, fSeconds) )
+
+    # A bounded window of jobs in flight, written in input order...
+    iWorkers = max(1, args.workers)
+    fStart = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=iWorkers) as executor:
+        dequeFutures = collections.deque()
+        for tupleJob in listJobs():
+            dequeFutures.append( executor.submit(transformJob, tupleJob) )
+            if len(dequeFutures) >= 2 * iWorkers:
+                writeJob( dequeFutures.popleft().result() )
+        while dequeFutures:
+            writeJob( dequeFutures.popleft().result() )
+    fSeconds = time.perf_counter() - fStart
+    sys.stderr.write( '%d queries, %d errors in %.3fs (%.1f queries/s)\n' % (iJobs, iErrors, fSeconds, iJobs / fSeconds if fSeconds > 0 else 0.0) )
+    return 1 if iErrors else 0
+
+def _packBindingValue(dictValue: dict | None) -> tuple | None:
+    """Pack a SPARQL JSON result value in a compact tuple"""
+    if dictValue is None:
+        return None
+    return ( dictValue.get('type', None), dictValue.get('value', None), dictValue.get('xml:lang', None), dictValue.get('datatype', None) )
+
+def _unpackBindingValue(tupleValue: tuple) -> dict:
+    strType, strValue, strLang, strDatatype = tupleValue
+    dictValue = { 'type': strType, 'value': strValue }
+    if strLang is not None:
+        dictValue['xml:lang'] = strLang
+    if strDatatype is not None:
+        dictValue['datatype'] = strDatatype
+    return dictValue
+
+def _writeRun(strPath: str, listRecords: list):
+    """Write a sorted run of records to a temporary file"""
+    import pickle
+    with open(strPath, 'wb') as fileRun:
+        for tupleRecord in listRecords:
+            pickle.dump(tupleRecord, fileRun, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _readRun(strPath: str):
+    """Read back the records of a run, one at a time"""
+    import pickle
+    with open(strPath, 'rb') as fileRun:
+        while True:
+            try:
+                yield pickle.load(fileRun)
+            except EOFError:
+                return
+
+
+g_dictThreadPools = {}
+g_lockThreadPools = threading.Lock()
+
+def _sharedThreadPool(iMaxWorkers: int):
+    """Get the thread pool shared by the chunked queries of all the transformers with the same 'maxWorkers', creating it when missing"""
+    with g_lockThreadPools:
+        executor = g_dictThreadPools.get(iMaxWorkers, None)
+        if executor is None:
+            import concurrent.futures
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=iMaxWorkers, thread_name_prefix='sparql-transformer')
+            g_dictThreadPools[iMaxWorkers] = executor
+        return executor
+
+g_dictProcessPools = {}
+g_lockProcessPools = threading.Lock()
+
+def _sharedProcessPool(iProcesses: int):
+    """ Get the process pool shared by the transformers with the same 'processes', creating it when missing.
+        NOTE: The workers are started by a fork server (or spawned), as forking a process with running threads
+              (e.g. the ones of a thread pool calling transform()) can deadlock.
+    """
+    with g_lockProcessPools:
+        executor = g_dictProcessPools.get(iProcesses, None)
+        if executor is None:
+            import concurrent.futures
+            import multiprocessing
+            strMethod = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=iProcesses, mp_context=multiprocessing.get_context(strMethod))
+            g_dictProcessPools[iProcesses] = executor
+        return executor
+
+def _discardProcessPool(executor):
+    with g_lockProcessPools:
+        for iProcesses, executorShared in list( g_dictProcessPools.items() ):
+            if executorShared is executor:
+                del g_dictProcessPools[iProcesses]
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def _processShard(dictProperties: dict, dictOptions: dict, listVars: list, listRows: list) -> list[tuple[int, dict]]:
+    """Worker process entry point: fit and merge a shard of bindings"""
+    return SPARQLTransformer.forFitting(dictProperties, dictOptions)._fitShard(listVars, listRows)
+
+def sparqlTransformer(objQuery: str | dict, dictOptions: dict | None = None):
+    """Transform a JSON query (a dict or the path of a JSON file), returning the results"""
+    return SPARQLTransformer(objQuery, dictOptions).transform()
+
 g_reAllowedPrefix = re.compile(r"^\w+[\w\d!$&'()*+,\-.:;=?@_~]*$", re.UNICODE)
 g_reAllowedSuffix = re.compile(r"^[\w\d!$&'()*+,\-.:;=?@_~]+$", re.UNICODE)
 
@@ -865,10 +2593,7 @@ def isCIRIE(strIRI: str, dictPrefixes: dict):
         return False
     if not g_reAllowedSuffix.fullmatch(strSuffix):
         return False
-    for strItemPrefix, strItemNamespace in dictPrefixes.items():
-        if strPrefix == strItemPrefix:
-            return True
-    return False
+    return strPrefix in dictPrefixes
 
 def isBlank(strIRI: str):
     parts = strIRI.split(":")
@@ -885,3 +2610,7 @@ def isBlank(strIRI: str):
 
 def isCIRIEorBlank(strIRI: str, dictPrefixes: dict):
     return isCIRIE(strIRI, dictPrefixes) or isBlank(strIRI)
+
+if __name__ == '__main__':
+    import sys
+    sys.exit( main() )
@@ -0,0 +1,304 @@
+"""
+End-to-end load test of SPARQL Transformer against a local mock SPARQL endpoint.
+
+The mock endpoint serves recorded results (e.g. ../examples/sparql_output/band.json) or synthetic ones
+built from the variables of the query, with configurable latency, bandwidth, payload size and errors.
+Transforms are driven at a target request rate (open loop) from threads, processes or asyncio, and the
+latency percentiles (from the scheduled start, so queueing counts), the throughput and the memory are reported.
+
+    python evaluation/loadtest.py examples/json_queries/band.json --results examples/sparql_output/band.json \
+        --rate 50 --requests 500 --driver threads --latency 0.05 --error-rate 0.01
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import statistics
+import concurrent.futures
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ) )
+from SPARQLTransformer import SPARQLTransformer # noqa: E402
+
+
+class MockEndpoint:
+    """ A local SPARQL endpoint answering every query with the same results:
+        - fLatency seconds (+/- fJitter) before answering,
+        - iBandwidth bytes per second, if given, to send the body,
+        - fErrorRate of the requests answered with iErrorCode (a 503 carries a Retry-After of 0).
+    """
+
+    def __init__(self, dictResults: dict, fLatency: float = 0.0, fJitter: float = 0.0, iBandwidth: int | None = None,
+                 fErrorRate: float = 0.0, iErrorCode: int = 503, strHost: str = '127.0.0.1', iPort: int = 0):
+        self.bytesBody = json.dumps(dictResults).encode()
+        self.fLatency = fLatency
+        self.fJitter = fJitter
+        self.iBandwidth = iBandwidth
+        self.fErrorRate = fErrorRate
+        self.iErrorCode = iErrorCode
+        self.iRequests = 0
+        self.iErrors = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer( (strHost, iPort), self.__handler() )
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return 'http://%s:%d/sparql' % self.server.server_address[:2]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __handler(self):
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.__answer()
+
+            def do_POST(self):
+                self.rfile.read( int( self.headers.get('Content-Length', 0) ) )
+                self.__answer()
+
+            def __answer(self):
+                with endpoint.lock:
+                    endpoint.iRequests += 1
+                fDelay = endpoint.fLatency + random.uniform(-endpoint.fJitter, endpoint.fJitter)
+                if fDelay > 0:
+                    time.sleep(fDelay)
+                if random.random() < endpoint.fErrorRate:
+                    with endpoint.lock:
+                        endpoint.iErrors += 1
+                    self.send_response(endpoint.iErrorCode)
+                    if endpoint.iErrorCode == 503:
+                        self.send_header('Retry-After', '0')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/sparql-results+json')
+                self.send_header('Content-Length', str( len(endpoint.bytesBody) ))
+                self.end_headers()
+                if not endpoint.iBandwidth:
+                    self.wfile.write(endpoint.bytesBody)
+                    return
+                # Throttled: a chunk every 10ms...
+                iChunk = max(1, endpoint.iBandwidth // 100)
+                for iStart in range(0, len(endpoint.bytesBody), iChunk):
+                    self.wfile.write( endpoint.bytesBody[iStart: iStart + iChunk] )
+                    time.sleep(0.01)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def syntheticResults(objQuery, iRows: int, iFanout: int = 1) -> dict:
+    """ Build SPARQL JSON results for the variables of a query: iRows rows,
+        iFanout consecutive rows sharing the same root anchor value.
+    """
+    dictPlan = SPARQLTransformer(objQuery).plan()
+    dictProperties = dictPlan['properties']
+    listVars = []
+    listItems = [dictProperties]
+    while listItems:
+        objItem = listItems.pop(0)
+        if isinstance(objItem, dict):
+            listItems.extend( objItem.values() )
+        elif isinstance(objItem, list):
+            listItems.extend(objItem)
+        elif isinstance(objItem, str) and objItem.startswith('?'):
+            strVar = objItem[1:].split('$')[0]
+            if strVar not in listVars:
+                listVars.append(strVar)
+    objAnchor = dictProperties.get( dictProperties.get('$anchor', ''), None )
+    strAnchorVar = objAnchor[1:].split('$')[0] if isinstance(objAnchor, str) and objAnchor.startswith('?') else None
+
+    listBindings = []
+    for iRow in range(iRows):
+        dictBinding = {}
+        for strVar in listVars:
+            if strVar == strAnchorVar:
+                dictBinding[strVar] = { 'type': 'uri', 'value': 'http://example.org/%s/%d' % (strVar, iRow // iFanout) }
+            else:
+                dictBinding[strVar] = { 'type': 'literal', 'value': '%s %d' % (strVar, iRow), 'xml:lang': 'en' }
+        listBindings.append(dictBinding)
+    return { 'head': { 'vars': listVars }, 'results': { 'bindings': listBindings } }
+
+
+def scaleResults(dictResults: dict, iRows: int) -> dict:
+    """Repeat the recorded bindings up to iRows rows"""
+    listBindings = dictResults['results']['bindings']
+    if not listBindings:
+        return dictResults
+    return dict( dictResults, results={ 'bindings': [ listBindings[i % len(listBindings)] for i in range(iRows) ] } )
+
+
+# Transformers of the worker processes, one per query...
+_dictTransformers = {}
+
+def _transformOnce(strQuery: str, dictOptions: dict) -> tuple[bool, str | None]:
+    objTransformer = _dictTransformers.get(strQuery, None)
+    if objTransformer is None:
+        objTransformer = _dictTransformers[strQuery] = SPARQLTransformer(strQuery, dictOptions)
+    try:
+        objTransformer.transform()
+    except Exception as e:
+        return (False, '%s: %s' % (type(e).__name__, e))
+    return (True, None)
+
+def _peakMemory(bChildren: bool = False) -> float | None:
+    """Peak resident memory in MB, if known"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    iPeak = resource.getrusage(resource.RUSAGE_CHILDREN if bChildren else resource.RUSAGE_SELF).ru_maxrss
+    return iPeak / (1024 * 1024) if sys.platform == 'darwin' else iPeak / 1024
+
+
+def runLoad(strQuery: str, dictOptions: dict, strDriver: str = 'threads', fRate: float = 10.0,
+            iRequests: int = 100, iConcurrency: int = 16) -> dict:
+    """ Send iRequests transforms at fRate per second (open loop) through the driver:
+        'threads', 'processes' or 'asyncio'. Return the measures.
+    """
+    listLatencies = []
+    listErrors = []
+
+    def record(fScheduled: float, tupleResult: tuple):
+        bOK, strError = tupleResult
+        listLatencies.append( time.perf_counter() - fScheduled )
+        if not bOK:
+            listErrors.append(strError)
+
+    fStart = time.perf_counter()
+    if strDriver in ('threads', 'processes'):
+        if strDriver == 'threads':
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=iConcurrency)
+            objTransformer = SPARQLTransformer(strQuery, dictOptions) # ...shared by the threads
+            funcSubmit = lambda: executor.submit(_transformShared, objTransformer)
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=iConcurrency)
+            funcSubmit = lambda: executor.submit(_transformOnce, strQuery, dictOptions)
+        with executor:
+            listPending = []
+            for iRequest in range(iRequests):
+                fScheduled = fStart + iRequest / fRate
+                fWait = fScheduled - time.perf_counter()
+                if fWait > 0:
+                    time.sleep(fWait)
+                future = funcSubmit()
+                future.add_done_callback( lambda future, fScheduled=fScheduled: record( fScheduled, future.result() ) )
+                listPending.append(future)
+            concurrent.futures.wait(listPending)
+    elif strDriver == 'asyncio':
+        import asyncio
+
+        async def drive():
+            loop = asyncio.get_running_loop()
+            objTransformer = SPARQLTransformer(strQuery, dictOptions)
+            semaphore = asyncio.Semaphore(iConcurrency)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=iConcurrency) as executor:
+                async def one(fScheduled):
+                    async with semaphore:
+                        tupleResult = await loop.run_in_executor(executor, _transformShared, objTransformer)
+                    record(fScheduled, tupleResult)
+                listTasks = []
+                for iRequest in range(iRequests):
+                    fScheduled = fStart + iRequest / fRate
+                    fWait = fScheduled - time.perf_counter()
+                    if fWait > 0:
+                        await asyncio.sleep(fWait)
+                    listTasks.append( asyncio.create_task( one(fScheduled) ) )
+                await asyncio.gather(*listTasks)
+
+        asyncio.run( drive() )
+    else:
+        raise ValueError('Unknown driver [%s]' % strDriver)
+    fElapsed = time.perf_counter() - fStart
+
+    listSorted = sorted(listLatencies)
+    def percentile(fQuantile):
+        return listSorted[ min( len(listSorted) - 1, int( fQuantile * len(listSorted) ) ) ] if listSorted else None
+    return {
+        'driver': strDriver,
+        'requests': len(listLatencies),
+        'errors': len(listErrors),
+        'seconds': fElapsed,
+        'throughput': len(listLatencies) / fElapsed if fElapsed > 0 else 0.0,
+        'p50': percentile(0.50),
+        'p95': percentile(0.95),
+        'p99': percentile(0.99),
+        'mean': statistics.mean(listLatencies) if listLatencies else None,
+        'peakMemoryMB': _peakMemory(strDriver == 'processes'),
+        'sampleErrors': listErrors[:5]
+    }
+
+def _transformShared(objTransformer) -> tuple[bool, str | None]:
+    try:
+        objTransformer.transform()
+    except Exception as e:
+        return (False, '%s: %s' % (type(e).__name__, e))
+    return (True, None)
+
+
+def main(listArgs: list | None = None) -> int:
+    parser = argparse.ArgumentParser(description='Load test SPARQL Transformer against a local mock SPARQL endpoint')
+    parser.add_argument('query', help='JSON query file')
+    parser.add_argument('--results', default=None, help='recorded SPARQL JSON results to serve (default: synthetic ones)')
+    parser.add_argument('--rows', type=int, default=None, help='rows served: recorded ones repeated, or synthetic ones (default: 100)')
+    parser.add_argument('--fanout', type=int, default=1, help='synthetic rows per root object (default: %(default)s)')
+    parser.add_argument('--driver', choices=['threads', 'processes', 'asyncio', 'all'], default='threads')
+    parser.add_argument('--rate', type=float, default=10.0, help='target requests per second (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=100, help='total requests (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=16, help='workers of the driver (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.0, help='endpoint latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='endpoint latency jitter in seconds')
+    parser.add_argument('--bandwidth', type=int, default=None, help='endpoint bandwidth in bytes per second')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests failing')
+    parser.add_argument('--error-code', type=int, default=503, help='HTTP status of the failing requests (default: %(default)s)')
+    parser.add_argument('--no-scheduler', action='store_true', help='bypass the request scheduler (no retries)')
+    args = parser.parse_args(listArgs)
+
+    if args.results:
+        with open(args.results) as fileResults:
+            dictResults = json.load(fileResults)
+        if args.rows:
+            dictResults = scaleResults(dictResults, args.rows)
+    else:
+        with open(args.query) as fileQuery:
+            dictResults = syntheticResults( json.load(fileQuery), args.rows or 100, args.fanout )
+
+    with MockEndpoint(dictResults, args.latency, args.jitter, args.bandwidth, args.error_rate, args.error_code) as endpoint:
+        dictOptions = { 'endpoint': endpoint.url }
+        if args.no_scheduler:
+            dictOptions['scheduler'] = False
+        listDrivers = ['threads', 'processes', 'asyncio'] if args.driver == 'all' else [args.driver]
+        for strDriver in listDrivers:
+            dictReport = runLoad(args.query, dictOptions, strDriver, args.rate, args.requests, args.concurrency)
+            print( json.dumps(dictReport) )
+        sys.stderr.write( 'endpoint: %d requests, %d errors injected, %d bytes per answer\n'
+                          % (endpoint.iRequests, endpoint.iErrors, len(endpoint.bytesBody)) )
+    return 0
+
+if __name__ == '__main__':
+    sys.exit( main() )
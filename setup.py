@@ -15,6 +15,9 @@ setup(name="SPARQLTransformer",
       install_requires=requirements,
       data_files=[('txt', ['requirements.txt'])],
       py_modules=["SPARQLTransformer"],
+      entry_points={
+          'console_scripts': ['sparql-transformer=SPARQLTransformer:main'],
+      },
 
       # metadata to display on PyPI
       author="Pasquale Lisena",
@@ -1,10 +1,19 @@
 import os
+import sys
 import json
+import time
 import string
+import itertools
+import tempfile
+import threading
 import unittest
+import urllib.error
+import urllib.parse
 from unittest.mock import patch
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from simplejson import dumps
-from SPARQLTransformer import sparqlTransformer, pre_process
+from SPARQLTransformer import sparqlTransformer
 import SPARQLTransformer
 
 OUTPUT = './examples/json_transformed/'
@@ -32,6 +41,13 @@ def mock(filename):
     return f
 
 
+def answering(filename):
+    """The SPARQL output file of a query, and the options of a transformer answered with it"""
+    with open(os.path.join(SPARQL_OUTPUT, filename)) as data:
+        obj = json.load(data)
+    return obj, {'sparqlFunction': lambda strQuery: obj}
+
+
 def load(filename):
     with open(os.path.join(JSONLD_QUERIES, filename)) as data:
         q = json.load(data)
@@ -44,14 +60,46 @@ def load(filename):
 
 
 def get_sparql_query(q):
-    query, proto, opt = pre_process(q, {'debug': False})
-    return query
+    queries = []
+    SPARQLTransformer.SPARQLTransformer(q, {'debug': False, 'sparqlFunction': lambda strQuery: queries.append(strQuery) or {'results': {'bindings': []}}}).transform()
+    return queries[0]
 
 
 def cleans(s):
     return s.translate({ord(c): None for c in string.whitespace})
 
 
+@contextmanager
+def endpoint(filename, respond=lambda handler: True, headers=None):
+    """A local SPARQL endpoint answering with a SPARQL output file, unless respond() answers first"""
+    with open(os.path.join(SPARQL_OUTPUT, filename)) as data:
+        body = data.read().encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if not respond(self):
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/sparql-results+json')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers() if callable(headers) else headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%d/sparql' % server.server_port
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 class TestStringMethods(unittest.TestCase):
     @patch.object(SPARQLTransformer.SPARQLWrapper, 'query', mock('city.list.json'))
     def test_proto(self):
@@ -162,6 +210,549 @@ class TestStringMethods(unittest.TestCase):
 
         self.assertEqual(dumps(out), dumps(expected))
 
+    def test_values_chunks(self):
+        q, expected, rq = load('band.json')
+        q['$values'] = {'genre': ['dbr:Grunge', 'dbr:Rock', 'dbr:Pop', 'dbr:Jazz', 'dbr:Punk']}
+        obj, _options = answering('band.json')
+        queries = []
+
+        def query(strQuery):
+            queries.append(strQuery)
+            return obj if 'dbr:Grunge' in strQuery else {'head': {}, 'results': {'bindings': []}}
+
+        single = SPARQLTransformer.SPARQLTransformer(q, {'sparqlFunction': query}).transform()
+        self.assertEqual(len(queries), 1)
+
+        queries.clear()
+        chunked = SPARQLTransformer.SPARQLTransformer(q, {'sparqlFunction': query, 'valuesChunkSize': 2}).transform()
+        self.assertEqual(len(queries), 3)
+        self.assertTrue(all('LIMIT' not in strQuery for strQuery in queries))
+        self.assertEqual(dumps(chunked), dumps(single))
+
+        # ...on a pool shared by the transforms
+        threads = set()
+        for _ in range(2):
+            SPARQLTransformer.SPARQLTransformer(q, {'sparqlFunction': lambda strQuery: threads.add(threading.current_thread()) or obj,
+                                                    'valuesChunkSize': 2}).transform()
+        self.assertLessEqual(len(threads), 4)
+        self.assertTrue(all(thread.name.startswith('sparql-transformer') for thread in threads))
+
+        # Without an anchor, the bindings found by several chunks are kept once, as with DISTINCT...
+        q, expected, rq = load('city.list.json')
+        del q['$limit'], q['proto']['id']
+        q['$values'] = {'v1': ['"Roma"@it', '"Milano"@it', '"Napoli"@it']}
+        obj, options = answering('city.list.json')
+        single = SPARQLTransformer.SPARQLTransformer(q, options).transform()
+        chunked = SPARQLTransformer.SPARQLTransformer(q, dict(options, valuesChunkSize=1)).transform()
+        self.assertEqual(dumps(chunked), dumps(single))
+
+    def test_values_rows(self):
+        q = {
+            'proto': {'id': '?s', 'label': '$rdfs:label$var:label'},
+            '$prefixes': {'dbo': 'http://dbpedia.org/ontology/'},
+            '$values': {
+                's label': [['dbo:Band', 'say "hi"\nbye'], ['<http://dbpedia.org/resource/Grunge>', None]],
+                'x': ['10^^xsd:int', 'Grunge@en', 'dbr:Grunge']
+            }
+        }
+        outSparql = get_sparql_query(q)
+        self.assertIn('VALUES (?s ?label) {(dbo:Band "say \\"hi\\"\\nbye") (<http://dbpedia.org/resource/Grunge> UNDEF)}', outSparql)
+        self.assertIn('VALUES ?x {"10"^^<xsd:int> "Grunge"@en "dbr:Grunge"}', outSparql)
+        self.assertIn('?s rdfs:label ?label .', outSparql)
+
+    def test_concat(self):
+        q = {
+            'proto': {
+                'band': '?id$anchor',
+                'label': '$rdfs:label$required$concat',
+                'genre': '$dbo:genre$list$concat'
+            },
+            '$where': '?id a dbo:Band'
+        }
+        result = {'results': {'bindings': [{
+            'id': {'type': 'uri', 'value': 'http://dbpedia.org/resource/Alice_in_Chains'},
+            'v1_concat': {'type': 'literal', 'value': '"Alice in Chains\x1een\x1e\x1f"AiC\x1e\x1e'},
+            'v2_concat': {'type': 'literal', 'value': '<http://dbpedia.org/resource/Grunge'}
+        }]}}
+
+        outSparql = get_sparql_query(q)
+        self.assertIn('AS ?v1_concat)', outSparql)
+        self.assertIn('GROUP BY ?id', outSparql)
+
+        out = SPARQLTransformer.SPARQLTransformer(q, {'sparqlFunction': lambda strQuery: result}).transform()
+        self.assertEqual(out, [{
+            'band': {'id': 'http://dbpedia.org/resource/Alice_in_Chains'},
+            'label': [{'value': 'Alice in Chains', 'language': 'en'}, 'AiC'],
+            'genre': [{'id': 'http://dbpedia.org/resource/Grunge'}]
+        }])
+
+    def test_processes(self):
+        q, expected, rq = load('band.json')
+        options = answering('band.json')[1]
+
+        single = SPARQLTransformer.SPARQLTransformer(q, options).transform()
+        sharded = SPARQLTransformer.SPARQLTransformer(q, dict(options, processes=2)).transform()
+        self.assertEqual(dumps(sharded), dumps(single))
+
+        # ...on a pool started once and shared by the transforms
+        pool = SPARQLTransformer.g_dictProcessPools[2]
+        sharded = SPARQLTransformer.SPARQLTransformer(q, dict(options, processes=2)).transform()
+        self.assertEqual(dumps(sharded), dumps(single))
+        self.assertIs(SPARQLTransformer.g_dictProcessPools[2], pool)
+
+    def test_update(self):
+        q, expected, rq = load('band.json')
+        obj, options = answering('band.json')
+        bindings = obj['results']['bindings']
+        last = bindings[-1]['id']['value']
+        removed = [b for b in bindings if b['id']['value'] == last]
+
+        # Count the groups fitted again...
+        fits = []
+        fitGroup = SPARQLTransformer.SPARQLTransformer._SPARQLTransformer__fitGroup
+
+        def countingFitGroup(self, listBindings):
+            fits.append(listBindings)
+            return fitGroup(self, listBindings)
+
+        transformer = SPARQLTransformer.SPARQLTransformer(q, dict(options, indexAnchors=True))
+        with patch.object(SPARQLTransformer.SPARQLTransformer, '_SPARQLTransformer__fitGroup', countingFitGroup):
+            run = transformer.run()
+            full = run.objResults
+            first = bindings[0]['id']['value']
+            untouched = run.dictAnchorIndex[first]['results']
+
+            updated, changes = transformer.update(run, listRemoved=removed)
+            self.assertEqual(changes, {'added': [], 'changed': [], 'removed': [last]})
+            self.assertEqual(dumps(updated.objResults), dumps(full[:-1]))
+            self.assertEqual(fits, [])
+
+            updated, changes = transformer.update(updated, listBindings=bindings)
+            self.assertEqual(changes, {'added': [last], 'changed': [], 'removed': []})
+            self.assertEqual(dumps(updated.objResults), dumps(full))
+            self.assertEqual(fits, [removed])
+            self.assertIs(updated.dictAnchorIndex[first]['results'], untouched)
+
+            # Without the index, the first update fits every group...
+            fits.clear()
+            run = SPARQLTransformer.SPARQLTransformer(q, options).run()
+            self.assertIsNone(run.dictAnchorIndex)
+            updated, changes = transformer.update(run, listRemoved=removed)
+            self.assertEqual(dumps(updated.objResults), dumps(full[:-1]))
+            self.assertEqual(len(fits), len(full))
+
+    def test_bundle(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'queries.bundle.json')
+            SPARQLTransformer.buildBundle(JSONLD_QUERIES, path)
+            plans = SPARQLTransformer.loadBundle(path)
+
+        q, expected, rq = load('band.json')
+        self.assertEqual(cleans(plans['band']['queries'][0]), cleans(get_sparql_query(q)))
+
+        options = answering('band.json')[1]
+        out = SPARQLTransformer.SPARQLTransformer.fromPlan(plans['band'], options).transform()
+        self.assertEqual(dumps(out), dumps(sparqlTransformer(q, options)))
+
+    def test_scheduler(self):
+        requests = []
+
+        def respond(handler):
+            requests.append(handler.path)
+            if len(requests) == 1:  # ...throttle the first request
+                handler.send_response(429)
+                handler.send_header('Retry-After', '0')
+                handler.end_headers()
+                return False
+            return True
+
+        with endpoint('band.json', respond) as url:
+            q, expected, rq = load('band.json')
+            scheduler = SPARQLTransformer.RequestScheduler(iInitialConcurrency=4)
+            out = SPARQLTransformer.SPARQLTransformer(q, {'endpoint': url, 'scheduler': scheduler}).transform()
+
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(len(out), 27)
+        self.assertLess(scheduler.fConcurrency, 4)
+        self.assertEqual(scheduler.iOutstanding, 0)
+
+        # Shared per endpoint and configuration...
+        shared = SPARQLTransformer.RequestScheduler.forEndpoint('http://a', fRate=2.0)
+        self.assertIs(SPARQLTransformer.RequestScheduler.forEndpoint('http://a', fRate=2.0, iBurst=None), shared)
+        self.assertEqual(SPARQLTransformer.RequestScheduler.forEndpoint('http://a', fRate=5.0).fRate, 5.0)
+        pool = SPARQLTransformer.EndpointPool.forEndpoints(['http://a', 'http://b'])
+        self.assertIs(SPARQLTransformer.EndpointPool.forEndpoints(['http://a', 'http://b'], bHedge=None), pool)
+        self.assertTrue(SPARQLTransformer.EndpointPool.forEndpoints(['http://a', 'http://b'], bHedge=True).bHedge)
+
+    def test_replicas(self):
+        q, expected, rq = load('band.json')
+        requests = []
+
+        def respond(handler):
+            requests.append(handler.server.server_port)
+            return True
+
+        def slow(handler):
+            time.sleep(0.5)
+            return respond(handler)
+
+        with endpoint('band.json', respond) as url1, endpoint('band.json', respond) as url2:
+            for _ in range(4):
+                SPARQLTransformer.SPARQLTransformer(q, {'endpoint': [url1, url2]}).transform()
+        self.assertEqual(len(set(requests)), 2)
+        self.assertEqual(requests.count(requests[0]), 2)
+
+        # Hedged: the fast replica answers for the slow one...
+        with endpoint('band.json', slow) as url1, endpoint('band.json', respond) as url2:
+            pool = SPARQLTransformer.EndpointPool([url1, url2], bHedge=True, fHedgeDelay=0.05)
+            start = time.monotonic()
+            out = SPARQLTransformer.SPARQLTransformer(q, {'endpoint': [url1, url2], 'endpointPool': pool}).transform()
+            self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(len(out), 27)
+
+        # A bad request is not a replica failure...
+        pool = SPARQLTransformer.EndpointPool(['a', 'b'], iMaxFailures=1)
+
+        def bad(strEndpoint, strQuery):
+            raise urllib.error.HTTPError(strEndpoint, 400, 'Bad Request', None, None)
+
+        for _ in range(2):
+            with self.assertRaises(urllib.error.HTTPError):
+                pool.request(bad, 'q')
+        self.assertEqual(pool.dictFailures, {'a': 0, 'b': 0})
+        self.assertEqual(pool.dictDownUntil, {'a': 0.0, 'b': 0.0})
+
+        # A throttled replica fails over at once, with no backoff on it...
+        def throttled(handler):
+            handler.send_error(503)
+            return False
+
+        with endpoint('band.json', throttled) as url1, endpoint('band.json', respond) as url2:
+            pool = SPARQLTransformer.EndpointPool([url1, url2])
+            for _ in range(2):
+                start = time.monotonic()
+                out = SPARQLTransformer.SPARQLTransformer(q, {'endpoint': [url1, url2], 'endpointPool': pool}).transform()
+                self.assertLess(time.monotonic() - start, 0.4)
+                self.assertEqual(len(out), 27)
+
+        # ...and all of them failing are retried by the pool
+        pool = SPARQLTransformer.EndpointPool(['a', 'b'], fBackoff=0.01)
+        calls = []
+
+        def flaky(strEndpoint, strQuery):
+            calls.append(strEndpoint)
+            if len(calls) <= 2:
+                raise urllib.error.HTTPError(strEndpoint, 503, 'Service Unavailable', None, None)
+            return strQuery
+
+        self.assertEqual(pool.request(flaky, 'q'), 'q')
+        self.assertEqual(len(calls), 3)
+
+    def test_deadline(self):
+        q, expected, rq = load('band.json')
+        obj, options = answering('band.json')
+        bindings = obj['results']['bindings']
+        full = sparqlTransformer(q, options)
+
+        # A slow endpoint: nothing is fitted after the deadline...
+        def slow(strQuery):
+            time.sleep(0.2)
+            return obj
+
+        run = SPARQLTransformer.SPARQLTransformer(q, {'sparqlFunction': slow, 'timeout': 0.1}).run()
+        self.assertEqual(run.objResults, [])
+        self.assertTrue(run.bTruncated)
+
+        # Out of time after 64 results: only the objects without results left are kept...
+        clock = itertools.count()
+        with patch.object(SPARQLTransformer.time, 'monotonic', lambda: next(clock)):
+            run = SPARQLTransformer.SPARQLTransformer(q, dict(options, timeout=2)).run()
+        out = run.objResults
+        self.assertTrue(run.bTruncated)
+        pending = {b['id']['value'] for b in bindings[64:]}
+        complete = [o for o in full if o['band']['id'] not in pending]
+        self.assertGreater(len(complete), 0)
+        self.assertEqual(dumps(out), dumps(complete))
+
+    def test_stream(self):
+        for name in ('band.json', 'city.list.json', 'band.liblimit.json'):
+            q, expected, rq = load(name)
+            obj, options = answering(name)
+            full = sparqlTransformer(q, options)
+
+            # Spilled in runs of 7 results, merged in anchor order...
+            out = []
+            transformer = SPARQLTransformer.SPARQLTransformer(q, dict(options, spillRows=7))
+            run = transformer.stream(out.append)
+            self.assertEqual(run.iResults, len(full))
+            self.assertEqual(sorted(dumps(o) for o in out), sorted(dumps(o) for o in full))
+            self.assertNotIn(None, obj['results']['bindings'])
+
+            # Through an endpoint, each batch of bindings is released once taken...
+            with endpoint(name) as url:
+                out = []
+                SPARQLTransformer.SPARQLTransformer(q, {'endpoint': url, 'spillRows': 7}).stream(out.append)
+            self.assertEqual(sorted(dumps(o) for o in out), sorted(dumps(o) for o in full))
+
+    def test_dedup(self):
+        q, expected, rq = load('band.json')
+        obj, options = answering('band.json')
+        full = sparqlTransformer(q, options)
+
+        # Each binding three times, differing only in a variable out of the prototype...
+        bindings = obj['results']['bindings']
+        obj['results']['bindings'] = [dict(b, helper={'type': 'literal', 'value': str(i)}) for b in bindings for i in range(3)]
+        run = SPARQLTransformer.SPARQLTransformer(q, options).run()
+        self.assertEqual(run.iSkippedRows, 2 * len(bindings))
+        self.assertEqual(dumps(run.objResults), dumps(full))
+
+    def test_shared_nodes(self):
+        q, expected, rq = load('city.region.list.ld.json')
+        options = answering('city.region.list.ld.json')[1]
+        full = sparqlTransformer(q, options)
+
+        # The cities in the same region share its object...
+        out = sparqlTransformer(q, dict(options, shareNodes=True))
+        self.assertEqual(dumps(out), dumps(full))
+        regions = {}
+        for city in out['@graph']:
+            region = regions.setdefault(city['containedInPlace']['@id'], city['containedInPlace'])
+            self.assertIs(city['containedInPlace'], region)
+        self.assertLess(len(regions), len(out['@graph']))
+
+        # Flattened: each region once in the graph, referenced by the cities...
+        out = sparqlTransformer(q, dict(options, flatten=True))
+        cities, nodes = out['@graph'][:len(full['@graph'])], out['@graph'][len(full['@graph']):]
+        self.assertEqual([city['@id'] for city in cities], [city['@id'] for city in full['@graph']])
+        self.assertEqual({node['@id'] for node in nodes}, set(regions))
+        self.assertEqual(len(nodes), len(regions))
+        for city, original in zip(cities, full['@graph']):
+            self.assertEqual(city['containedInPlace'], {'@id': original['containedInPlace']['@id']})
+            self.assertIn(original['containedInPlace'], nodes)
+
+    def test_cache(self):
+        q, expected, rq = load('band.json')
+        obj, _options = answering('band.json')
+        queries = []
+
+        def f(strQuery):
+            queries.append(strQuery)
+            return obj
+
+        cache = SPARQLTransformer.ResultCache(1)
+        first = SPARQLTransformer.SPARQLTransformer(q, {'sparqlFunction': f, 'cache': cache}).transform()
+        first[0]['changed'] = True
+        run = SPARQLTransformer.SPARQLTransformer(q, {'sparqlFunction': f, 'cache': cache}).run()
+        self.assertTrue(run.bCached)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('changed', run.objResults[0])
+        self.assertEqual(len(run.objResults), 27)
+
+        # Another query evicts it...
+        q2, expected, rq = load('band.liblimit.json')
+        SPARQLTransformer.SPARQLTransformer(q2, {'sparqlFunction': f, 'cache': cache}).transform()
+        SPARQLTransformer.SPARQLTransformer(q, {'sparqlFunction': f, 'cache': cache}).transform()
+        self.assertEqual(len(queries), 3)
+
+    def test_revalidation(self):
+        q, expected, rq = load('band.json')
+        etag = {'value': '"v1"'}
+        statuses = []
+
+        def respond(handler):
+            if handler.headers.get('If-None-Match') == etag['value']:
+                statuses.append(304)
+                handler.send_response(304)
+                handler.send_header('ETag', etag['value'])
+                handler.end_headers()
+                return False
+            statuses.append(200)
+            return True
+
+        def headers():
+            return {'ETag': etag['value'], 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+
+        # Always expired: each transform revalidates the cached results...
+        cache = SPARQLTransformer.ResultCache(fTTL=0)
+        with endpoint('band.json', respond, headers) as url:
+            first = SPARQLTransformer.SPARQLTransformer(q, {'endpoint': url, 'cache': cache}).run()
+            time.sleep(0.01)
+            run = SPARQLTransformer.SPARQLTransformer(q, {'endpoint': url, 'cache': cache}).run()
+            self.assertTrue(run.bCached and run.bRevalidated)
+            self.assertEqual(dumps(run.objResults), dumps(first.objResults))
+            self.assertEqual(statuses, [200, 304])
+
+            # Changed: queried and transformed again...
+            etag['value'] = '"v2"'
+            time.sleep(0.01)
+            run = SPARQLTransformer.SPARQLTransformer(q, {'endpoint': url, 'cache': cache}).run()
+            self.assertFalse(run.bCached)
+            self.assertEqual(statuses, [200, 304, 200])
+            self.assertEqual(len(run.objResults), 27)
+
+    def test_cli(self):
+        import io
+        from contextlib import redirect_stdout, redirect_stderr
+        with endpoint('band.json') as url:
+            out, err = io.StringIO(), io.StringIO()
+            with redirect_stdout(out), redirect_stderr(err):
+                code = SPARQLTransformer.main(['run', os.path.join(JSONLD_QUERIES, 'band.json'),
+                                               os.path.join(JSONLD_QUERIES, 'band.liblimit.json'), '-e', url, '-w', '2'])
+            self.assertEqual(code, 0)
+            lines = out.getvalue().splitlines()
+            self.assertEqual([len(json.loads(line)) for line in lines], [27, 10])
+            self.assertIn('2 queries, 0 errors', err.getvalue())
+
+
+        # Parameter rows bound as $values, the repeated one from the cache...
+        queries = []
+
+        def respond(handler):
+            queries.append(urllib.parse.parse_qs(urllib.parse.urlparse(handler.path).query)['query'][0])
+            return True
+
+        nirvana, pearljam = '<http://dbpedia.org/resource/Nirvana_(band)>', '<http://dbpedia.org/resource/Pearl_Jam>'
+        rows = ''.join(json.dumps({'id': iri}) + '\n' for iri in (nirvana, pearljam, nirvana))
+        with endpoint('band.json', respond) as url:
+            out, err = io.StringIO(), io.StringIO()
+            with redirect_stdout(out), redirect_stderr(err), patch('sys.stdin', io.StringIO(rows)):
+                code = SPARQLTransformer.main(['run', '-q', os.path.join(JSONLD_QUERIES, 'band.json'), '-e', url, '-w', '1'])
+        self.assertEqual(code, 0)
+        self.assertEqual([query.count('VALUES ?id {%s}' % iri) for query, iri in zip(queries, (nirvana, pearljam))], [1, 1])
+        self.assertEqual(len(queries), 2)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[2], lines[0])
+        self.assertIn('band.json:3\tcached', err.getvalue())
+
+    def test_loadtest(self):
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('loadtest', os.path.join('evaluation', 'loadtest.py'))
+        loadtest = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(loadtest)
+
+        query = os.path.join(JSONLD_QUERIES, 'band.json')
+        with open(query) as data:
+            results = loadtest.syntheticResults(json.load(data), 40, 4)
+        self.assertEqual(len(results['results']['bindings']), 40)
+        with loadtest.MockEndpoint(results, fLatency=0.01) as mock:
+            self.assertEqual(len(sparqlTransformer(query, {'endpoint': mock.url})), 10)
+            for driver in ('threads', 'asyncio'):
+                report = loadtest.runLoad(query, {'endpoint': mock.url}, driver, fRate=100, iRequests=5, iConcurrency=2)
+                self.assertEqual((report['requests'], report['errors']), (5, 0))
+                self.assertLessEqual(report['p50'], report['p99'])
+
+    def test_table(self):
+        q, expected, rq = load('band.json')
+        obj, options = answering('band.json')
+        table = SPARQLTransformer.SPARQLTransformer(q, options).table()
+        self.assertEqual(list(table), ['band', 'label', 'genre'])
+        self.assertEqual(table['band'], [b['id']['value'] for b in obj['results']['bindings']])
+
+        # Dotted paths and typed values...
+        q = {'proto': {'id': '?id', 'team': {'id': '?team', 'capacity': '?capacity', 'big': '?big'}}, '$where': '?id ?p ?team'}
+        xsd = 'http://www.w3.org/2001/XMLSchema#'
+        bindings = [
+            {'id': {'type': 'uri', 'value': 'http://ex.org/a'}, 'team': {'type': 'uri', 'value': 'http://ex.org/t1'},
+             'capacity': {'type': 'literal', 'value': '30000', 'datatype': xsd + 'integer'},
+             'big': {'type': 'literal', 'value': 'true', 'datatype': xsd + 'boolean'}},
+            {'id': {'type': 'uri', 'value': 'http://ex.org/b'}, 'team': {'type': 'uri', 'value': 'http://ex.org/t2'}},
+        ]
+        transformer = SPARQLTransformer.SPARQLTransformer(q, {'sparqlFunction': lambda strQuery: {'results': {'bindings': bindings}}})
+        table = transformer.table()
+        self.assertEqual(table, {'id': ['http://ex.org/a', 'http://ex.org/b'], 'team.id': ['http://ex.org/t1', 'http://ex.org/t2'],
+                                 'team.capacity': [30000, None], 'team.big': [True, None]})
+        try:
+            import numpy
+            import pandas
+        except ImportError:
+            return
+        array = transformer.table('numpy')
+        self.assertEqual(array.dtype['team.capacity'], numpy.dtype('f8'))
+        self.assertEqual(array['team.capacity'][0], 30000)
+        self.assertTrue(numpy.isnan(array['team.capacity'][1]))
+        frame = transformer.table('pandas')
+        self.assertEqual(str(frame['team.capacity'].dtype), 'Int64')
+        self.assertEqual(list(frame['id']), table['id'])
+
+    def test_bestlang_portable(self):
+        q, expected, rq = load('city.region.list.ld.json')
+        obj, options = answering('city.region.list.ld.json')
+        full = sparqlTransformer(q, options)
+
+        portable = dict(q, **{'$bestlangMode': 'portable'})
+        query = SPARQLTransformer.SPARQLTransformer(portable).plan()['queries'][0]
+        self.assertNotIn('BEST_LANGMATCH', query)
+        self.assertNotIn('LIMIT', query)
+
+        # Worse languages first: only the best one is kept, Italian when there is no English...
+        bindings = []
+        for i, b in enumerate(obj['results']['bindings']):
+            label = b['v2']['value']
+            for lang in ('fr', 'it') if i == 0 else ('fr', 'it', 'en'):
+                bindings.append(dict(b, v2={'type': 'literal', 'value': label + '@' + lang, 'xml:lang': lang}))
+        out = sparqlTransformer(portable, {'sparqlFunction': lambda strQuery: {'results': {'bindings': bindings}}})
+        self.assertEqual(len(out['@graph']), len(full['@graph']))
+        for city, original in zip(out['@graph'], full['@graph']):
+            lang = 'it' if city is out['@graph'][0] else 'en'
+            self.assertEqual(city['name'], {'@value': original['name']['@value'] + '@' + lang, '@language': lang})
+            self.assertEqual(city['containedInPlace'], original['containedInPlace'])
+
+        # ...the same when merged in a pool of processes
+        sharded = sparqlTransformer(portable, {'sparqlFunction': lambda strQuery: {'results': {'bindings': bindings}}, 'processes': 2})
+        self.assertEqual(dumps(sharded), dumps(out))
+
+        # ...and in a table: a row per city, in its best language
+        table = SPARQLTransformer.SPARQLTransformer(portable, {'sparqlFunction': lambda strQuery: {'results': {'bindings': bindings}}}).table()
+        self.assertEqual(table['name'], [city['name']['@value'] for city in out['@graph']])
+
+    def test_threads(self):
+        # One transformer shared by many threads, each with its own results...
+        outputs = {}
+        for name in ('band.json', 'city.list.json'):
+            q, expected, rq = load(name)
+            options = answering(name)[1]
+            outputs[name] = (q, options, sparqlTransformer(q, options))
+
+        for name, (q, options, full) in outputs.items():
+            transformer = SPARQLTransformer.SPARQLTransformer(q, options)
+            results, errors = [], []
+
+            def work():
+                try:
+                    for i in range(5):
+                        results.append(dumps(transformer.transform()))
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=work) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(results, [dumps(full)] * 40)
+
+    @unittest.skipUnless(getattr(sys, '_is_gil_enabled', lambda: True)() is False, 'requires a free-threaded build')
+    def test_threads_scaling(self):
+        q, expected, rq = load('band.json')
+        obj, options = answering('band.json')
+        obj['results']['bindings'] = obj['results']['bindings'] * 20
+        transformer = SPARQLTransformer.SPARQLTransformer(q, options)
+        transformer.transform()
+
+        def timed(threads):
+            start = time.perf_counter()
+            listThreads = [threading.Thread(target=lambda: [transformer.transform() for i in range(8 // threads)])
+                           for i in range(threads)]
+            for thread in listThreads:
+                thread.start()
+            for thread in listThreads:
+                thread.join()
+            return time.perf_counter() - start
+
+        self.assertGreater(timed(1) / timed(4), 2)
+
 
 if __name__ == '__main__':
     unittest.main()